@@ -0,0 +1,117 @@
+"""导航页面同步与树构建的基准测试.
+
+生成指定规模的AdminGroup菜单树和system_page数据表(SQLite),统计各操作的耗时,SQL语句数量和内存峰值.
+需要先安装本项目(pip install -e .),或者在项目根目录下通过PYTHONPATH指定源码目录:
+
+    pip install -e . && python benchmarks/bench_nav.py --breadth 5 --depth 3 --pages 4
+    PYTHONPATH=. python benchmarks/bench_nav.py --breadth 5 --depth 3 --pages 4
+"""
+import argparse
+import time
+import tracemalloc
+from typing import Callable, List
+
+from fastapi_amis_admin.admin.admin import AdminGroup, PageSchemaAdmin
+from fastapi_amis_admin.admin.settings import Settings
+from fastapi_amis_admin.admin.site import AdminSite
+from fastapi_amis_admin.amis import PageSchema
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import Session
+from sqlmodel import SQLModel
+
+from fastapi_amis_admin_nav.models import NavPage
+from fastapi_amis_admin_nav.utils import AmisPageManager, include_children
+
+
+def make_admin(cls, app, label: str, unique_id: str):
+    admin = cls(app)
+    admin.page_schema = PageSchema(label=label, url=f"/{unique_id}")
+    setattr(admin, "unique_id", unique_id)  # noqa: B010
+    return admin
+
+
+def make_site_tree(site: AdminSite, breadth: int, depth: int, pages: int) -> AdminGroup:
+    """生成菜单树: 每个分组包含pages个页面和breadth个子分组,共depth层"""
+    root = make_admin(AdminGroup, site, "root", "root")
+    stack = [(root, 0)]
+    while stack:
+        group, level = stack.pop()
+        for i in range(pages):
+            group.append_child(make_admin(PageSchemaAdmin, site, f"page{i}", f"{group.unique_id}-p{i}"))
+        if level >= depth:
+            continue
+        for i in range(breadth):
+            child = make_admin(AdminGroup, site, f"group{i}", f"{group.unique_id}-g{i}")
+            group.append_child(child)
+            stack.append((child, level + 1))
+    return root
+
+
+def reverse_links(links: List[dict]) -> List[dict]:
+    """反转每一级菜单的顺序,模拟拖拽排序"""
+    stack = [links]
+    while stack:
+        items = stack.pop()
+        items.reverse()
+        stack.extend(item["children"] for item in items if item.get("children"))
+    return links
+
+
+class Bench:
+    def __init__(self, engine):
+        self.statements = 0
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args, **kwargs):
+        self.statements += 1
+
+    def run(self, name: str, fn: Callable):
+        self.statements = 0
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:<36}{elapsed * 1000:>12.2f}{self.statements:>10}{peak / 1024 / 1024:>12.2f}")
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--breadth", type=int, default=5, help="每个分组的子分组数量")
+    parser.add_argument("--depth", type=int, default=3, help="分组的层数")
+    parser.add_argument("--pages", type=int, default=4, help="每个分组的页面数量")
+    parser.add_argument("--database-url", default="sqlite://", help="数据库连接地址")
+    args = parser.parse_args()
+
+    site = AdminSite(settings=Settings(database_url_async="sqlite+aiosqlite://"))
+    root = make_site_tree(site, args.breadth, args.depth, args.pages)
+    engine = create_engine(args.database_url)
+    SQLModel.metadata.create_all(engine)
+    bench = Bench(engine)
+    print(f"{'operation':<36}{'time(ms)':>12}{'queries':>10}{'peak(MB)':>12}")
+
+    with Session(engine) as session:
+        bench.run("site_to_db (initial)", lambda: AmisPageManager(session).site_to_db(root))
+        session.commit()
+    with Session(engine) as session:
+        bench.run("site_to_db (unchanged)", lambda: AmisPageManager(session).site_to_db(root))
+        session.commit()
+    with Session(engine) as session:
+        bench.run("db_to_site", lambda: AmisPageManager(session).db_to_site(root))
+        session.rollback()
+    with Session(engine) as session:
+        links = bench.run("get_db_active_pages", lambda: AmisPageManager(session).get_db_active_pages())
+    with Session(engine) as session:
+        reverse_links(links)
+        bench.run("update_db_pages_parent_and_sort", lambda: AmisPageManager(session).update_db_pages_parent_and_sort(links))
+        session.commit()
+    with Session(engine) as session:
+        rows = session.execute(select(NavPage.id, NavPage.parent_id)).all()
+    items = [{"id": row.id, "parent_id": row.parent_id} for row in rows]
+    bench.run(f"include_children ({len(items)} nodes)", lambda: include_children(items))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,48 @@
-from typing import Any, Dict, List
+import asyncio
+import functools
+import json
+import logging
+from contextlib import nullcontext
+from typing import Any, AsyncIterator, Dict, Hashable, List, Optional
 
-from fastapi import Body
+from fastapi import Body, HTTPException, Query, status
+from fastapi.encoders import jsonable_encoder
 from fastapi_amis_admin import admin, amis
 from fastapi_amis_admin.admin import AdminApp
-from fastapi_amis_admin.amis import Form, TableCRUD
+from fastapi_amis_admin.amis import Action, Form, TableCRUD
 from fastapi_amis_admin.amis.components import Page, PageSchema
 from fastapi_amis_admin.crud import BaseApiOut, ItemListSchema
-from fastapi_amis_admin.crud.base import SchemaCreateT
+from fastapi_amis_admin.crud.base import SchemaCreateT, SchemaFilterT
+from sqlalchemy import event, select
 from sqlalchemy.engine import Result
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import BinaryExpression
+from sqlalchemy_database import AsyncDatabase
 from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
+from fastapi_amis_admin_nav.cache import NavCache, etag_matches, make_etag
+from fastapi_amis_admin_nav.invalidation import (
+    BaseInvalidationChannel,
+    DBPollingChannel,
+)
 from fastapi_amis_admin_nav.models import NavPage, NavPageType
-from fastapi_amis_admin_nav.utils import AmisPageManager, include_children
+from fastapi_amis_admin_nav.schema_store import PageSchemaStore
+from fastapi_amis_admin_nav.tracing import NavTracer
+from fastapi_amis_admin_nav.utils import (
+    DEFAULT_MAX_DEPTH,
+    EXPORT_EXCLUDE,
+    AmisPageManager,
+    AsyncAmisPageManager,
+    NavTreeError,
+    check_page_path,
+    include_children,
+    parse_import_page,
+    site_fingerprint,
+    upgrade_db_tables,
+)
+
+logger = logging.getLogger("fastapi_amis_admin_nav")
 
 
 class NavPageAdmin(admin.ModelAdmin):
@@ -19,6 +50,8 @@ class NavPageAdmin(admin.ModelAdmin):
     page_parser_mode = "html"  # 页面显示为iframe
     model = NavPage
     list_per_page = 100
+    list_lazy_children = False  # 按树分页: 只分页查询根级页面,子页面展开时通过deferApi分页加载;使用其他筛选条件时按普通列表分页
+    list_default_filters: Dict[str, Any] = {"is_active": True}  # 列表的默认筛选条件
     list_display = [
         NavPage.id,
         NavPage.label,
@@ -72,15 +105,121 @@ class NavPageAdmin(admin.ModelAdmin):
         NavPage.page_schema,
     ]
 
+    nav_cache_control: str = "no-cache"  # 导航菜单响应的Cache-Control,默认每次使用ETag向服务器验证
+    import_batch_size: int = 1000  # 导入导出页面时,每批处理的页面数量
+    invalidation_channel: Optional[BaseInvalidationChannel] = None  # 多进程页面变更通知通道,默认使用数据库轮询
+    invalidation_poll_interval: float = 5  # 轮询页面变更的间隔秒数,为0则不轮询
+    page_schema_store: Optional[PageSchemaStore] = None  # 页面配置存储,设置后页面配置按哈希去重并压缩保存
+    page_max_depth: int = DEFAULT_MAX_DEPTH  # 菜单的最大层级.超过最大层级,或者上级菜单形成循环时,同步和排序返回错误
+    tracer: Optional[NavTracer] = None  # 页面管理操作的追踪器,设置后记录各阶段的耗时统计,并且通过/trace_reports接口查看
+
     def __init__(self, app: "AdminApp"):
         super().__init__(app)
+        self.nav_cache = NavCache()
+        self.invalidation_channel = self.invalidation_channel or DBPollingChannel(self.site.db)
+        self._pages_versions: Dict[str, int] = {}
+        self._watch_task: Optional[asyncio.Task] = None
+        if self.tracer:
+            self.tracer.caches["nav_cache"] = lambda: (self.nav_cache.hits, self.nav_cache.misses)
+            if self.page_schema_store:
+                cache = self.page_schema_store.cache
+                self.tracer.caches["page_schema_store"] = lambda: (cache.hits, cache.misses)
 
         @self.site.fastapi.on_event("startup")
         async def sync_pages():
-            await self.site.db.async_run_sync(
-                lambda session: AmisPageManager(session).site_to_db(self.site).db_to_site(self.site)
-            )
+            # 旧版本创建的页面表缺少新增的列,先升级表结构
+            upgraded = await self.site.db.async_run_sync(upgrade_db_tables, is_session=False)
+            if upgraded:
+                logger.info("Added columns to nav pages table: %s", ", ".join(upgraded))
+            fingerprint = site_fingerprint(self.site)  # 必须在同步到site之前计算
+            try:
+                if upgraded:  # 新增的路径索引列需要重建
+                    await self.run_page_manager("rebuild_pages_path")
+                updated = await self.run_page_manager("sync_site", self.site, fingerprint)
+            except NavTreeError as error:  # 菜单数据有误时,保持site默认菜单,不影响启动
+                logger.error("Failed to sync nav pages: %s", error.msg)
+                await self.site.db.async_rollback()
+                updated = False
+            if updated:
+                await self.on_pages_changed()
+            self._pages_versions = await self.invalidation_channel.get_versions(["pages", "site"])
             await self.site.db.async_commit()
+            if self.invalidation_poll_interval:
+                self._watch_task = asyncio.create_task(self.watch_pages_changed())
+
+        @self.site.fastapi.on_event("shutdown")
+        async def stop_watch_pages():
+            if self._watch_task:
+                self._watch_task.cancel()
+
+    async def run_page_manager(self, method: str, *args, **kwargs):
+        """调用页面管理器的方法.异步数据库使用AsyncAmisPageManager,同步数据库则在线程池中使用AmisPageManager"""
+        with self.tracer.trace(method) if self.tracer else nullcontext():
+            if isinstance(self.db, AsyncDatabase):
+                manager = AsyncAmisPageManager(self.db.session, self.page_schema_store, self.page_max_depth)
+                return await getattr(manager, method)(*args, **kwargs)
+            return await self.db.async_run_sync(
+                lambda session: getattr(AmisPageManager(session, self.page_schema_store, self.page_max_depth), method)(
+                    *args, **kwargs
+                )
+            )
+
+    async def sync_db_to_site(self):
+        """将数据库中的菜单页面同步到site中.
+        先在旁路计算出新的菜单结构,再在事件循环中一次性发布,正在渲染菜单的请求不会读取到修改了一半的子页面列表
+        """
+        plan = await self.run_page_manager("plan_db_to_site", self.site)
+        plan.publish()
+
+    async def on_nav_tree_error(self, error: NavTreeError) -> BaseApiOut:
+        """菜单树结构错误时,回滚本次修改,返回错误信息"""
+        await self.db.async_rollback()
+        return BaseApiOut(status=-1, msg=error.msg, data=error.dict())
+
+    async def on_pages_changed(self, reload_site: bool = False):
+        """页面数据变更后调用,通知其他进程,并且在当前事务提交后使导航缓存失效.
+        reload_site: 是否通知其他进程重新同步site菜单
+        """
+        topics = ["pages", "site"] if reload_site else ["pages"]
+        pending = [{topic: await self.invalidation_channel.publish(topic) for topic in topics}]
+
+        def on_commit(session_: Session):
+            # 事务提交前失效,并发请求可能读取到旧数据并且缓存到新版本下;
+            # 提交前记录版本号,事务回滚后本进程会错过其他进程发布的相同版本号
+            if pending and not session_.in_nested_transaction():  # 保存点的提交不是最终提交
+                self._pages_versions.update(pending.pop())
+                self.nav_cache.invalidate()
+
+        def on_rollback(session_: Session):
+            if not session_.in_nested_transaction():  # 事务回滚,本次变更作废
+                pending.clear()
+
+        session = self.db.session
+        session = getattr(session, "sync_session", session)
+        event.listen(session, "after_commit", on_commit)
+        event.listen(session, "after_rollback", on_rollback)
+
+    async def watch_pages_changed(self):
+        """轮询页面版本号,其他进程变更页面后,使本进程的导航缓存失效并且重新同步site菜单"""
+        while True:
+            await asyncio.sleep(self.invalidation_poll_interval)
+            try:
+                async with self.db():
+                    await self.check_pages_changed()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to check nav pages changes")
+
+    async def check_pages_changed(self):
+        """对比页面版本号,如果变更则刷新"""
+        versions = await self.invalidation_channel.get_versions(["pages", "site"])
+        if versions["site"] != self._pages_versions.get("site"):
+            await self.sync_db_to_site()
+            await self.db.async_rollback()  # 仅同步到site,数据库的变更由发起变更的进程负责
+        if versions["pages"] != self._pages_versions.get("pages"):
+            self.nav_cache.invalidate()
+        self._pages_versions.update(versions)
 
     async def get_page(self, request: Request) -> Page:
         page = await super().get_page(request)
@@ -99,27 +238,199 @@ class NavPageAdmin(admin.ModelAdmin):
     def register_router(self):
         @self.router.post("/reload")
         async def reload_site_page_schema(request: Request):
-            await self.db.async_run_sync(lambda session: AmisPageManager(session).db_to_site(self.site))
+            try:
+                await self.sync_db_to_site()
+            except NavTreeError as error:
+                return await self.on_nav_tree_error(error)
+            await self.on_pages_changed(reload_site=True)
             return BaseApiOut(msg="success")
 
         @self.router.get("/get_active_pages")
         async def get_active_pages(request: Request):
-            items = await self.db.async_run_sync(lambda session: AmisPageManager(session).get_db_active_pages())
-            # 将根节点的子节点提取出来
-            if items:
-                root = items[0]
-                children = items[0]["children"]
-                root["children"] = []
-                items = [root, *children, *items[1:]]
-            return BaseApiOut(data=items)
+            permission_key = await self.get_nav_permission_key(request)
+            with self.tracer.trace("get_active_pages") if self.tracer else nullcontext():  # 统计包含导航缓存的命中
+                version = self.nav_cache.version
+                cached = self.nav_cache.get(("active_pages", permission_key))
+                if cached is None:  # 相同权限标识的用户共享同一份导航菜单
+                    content = await self.get_active_pages_content(permission_key)
+                    cached = self.nav_cache.set(("active_pages", permission_key), (content, make_etag(content)), version)
+            content, etag = cached
+            headers = {"ETag": etag, "Cache-Control": self.nav_cache_control}
+            if etag_matches(request.headers.get("if-none-match"), etag):  # 导航未变更,直接返回304
+                return Response(status_code=304, headers=headers)
+            return Response(content=content, media_type="application/json", headers=headers)
+
+        if self.list_lazy_children:
+
+            @self.router.get("/get_children")
+            async def get_children(request: Request, parent_id: int, page: int = Query(1, ge=1)):
+                """分页加载子页面,每页list_per_page个;还有更多子页面时,末尾追加一个"加载更多"的行,展开时加载下一页"""
+                # 只有使用默认筛选条件时才会展开子页面,子页面同样按默认筛选条件过滤
+                sel = (await self.get_select(request)).where(
+                    NavPage.parent_id == parent_id, *self.calc_filter_clause(dict(self.list_default_filters))
+                )
+                sel = sel.order_by(NavPage.sort.desc(), NavPage.id).offset((page - 1) * self.list_per_page)
+                rows = (await self.db.async_execute(sel.limit(self.list_per_page + 1))).all()
+                items = await self.set_items_defer(self.parser.conv_row_to_dict(rows[: self.list_per_page]))
+                children = [self.list_item(item) for item in items]
+                has_more = len(rows) > self.list_per_page
+                if has_more:
+                    children.append(
+                        {
+                            "id": f"{parent_id}-{page + 1}",
+                            "label": "加载更多...",
+                            "defer": True,
+                            "load_more": True,  # 不显示行操作按钮
+                            "deferApi": f"get:{self.router_path}/get_children?parent_id={parent_id}&page={page + 1}",
+                        }
+                    )
+                return BaseApiOut(data={"children": children, "hasMore": has_more})
 
         @self.router.post("/update_pages")
         async def update_pages(request: Request, data: List[dict] = Body(..., embed=True)):
-            await self.db.async_run_sync(lambda session: AmisPageManager(session).update_db_pages_parent_and_sort(data))
-            return BaseApiOut(msg="success")
+            try:
+                count = await self.run_page_manager("update_db_pages_parent_and_sort", data)
+            except NavTreeError as error:
+                return await self.on_nav_tree_error(error)
+            if count:
+                await self.on_pages_changed()
+            return BaseApiOut(msg="success", data=count)
+
+        @self.router.get("/export_pages")
+        async def export_pages(request: Request):
+            return StreamingResponse(
+                self.iter_export_pages(),
+                media_type="application/x-ndjson",
+                headers={"Content-Disposition": 'attachment; filename="system_page.ndjson"'},
+            )
+
+        @self.router.post("/import_pages")
+        async def import_pages(request: Request):
+            pages, buffer, line_no = [], b"", 0
+            async for chunk in request.stream():
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                for line in lines:
+                    line_no += 1
+                    if line.strip():
+                        try:
+                            pages.append(parse_import_page(line))
+                        except ValueError:
+                            return BaseApiOut(status=-1, msg=f"第{line_no}行数据格式错误")
+            if buffer.strip():
+                try:
+                    pages.append(parse_import_page(buffer))
+                except ValueError:
+                    return BaseApiOut(status=-1, msg=f"第{line_no + 1}行数据格式错误")
+            try:
+                count = await self.run_page_manager("import_pages", pages, batch_size=self.import_batch_size)
+                await self.run_page_manager("reset_site_fingerprint")  # 导入的数据可能修改了系统页面
+                await self.sync_db_to_site()  # 导入完成后,只同步一次site
+            except NavTreeError as error:
+                return await self.on_nav_tree_error(error)
+            await self.on_pages_changed(reload_site=True)
+            return BaseApiOut(msg="success", data=count)
+
+        if self.tracer:
+
+            @self.router.get("/trace_reports")
+            async def get_trace_reports(request: Request):
+                """最近的页面管理操作统计报告,最新的在前"""
+                return BaseApiOut(data=[report.dict() for report in reversed(self.tracer.reports)])
 
         return super().register_router()
 
+    async def iter_export_pages(self) -> AsyncIterator[bytes]:
+        """分批导出所有页面,每行一个json,上级页面通过parent_unique_id关联.
+        根页面标记site_root,导入时合并到当前的根页面;上级页面不存在的页面导出为顶级页面.
+        """
+        unique_ids: Dict[int, str] = {}
+        site_root = True  # 按(depth, id)排序,第一个没有上级的页面即为根页面
+        after = (-1, 0)
+        async with self.db():
+            while True:
+                pages = await self.run_page_manager("get_pages_chunk", after, limit=self.import_batch_size)
+                if not pages:
+                    break
+                page_schemas = await self.run_page_manager("load_page_schemas", pages)
+                lines = []
+                for page in pages:
+                    unique_ids[page.id] = page.unique_id
+                    data = jsonable_encoder(page.dict(exclude=EXPORT_EXCLUDE))
+                    data["page_schema"] = page_schemas.get(page.page_schema_hash, page.page_schema)
+                    data["parent_unique_id"] = unique_ids.get(page.parent_id)
+                    if site_root and page.parent_id is None:
+                        data["site_root"], site_root = True, False
+                    lines.append(json.dumps(data, ensure_ascii=False))
+                after = (pages[-1].depth, pages[-1].id)
+                yield ("\n".join(lines) + "\n").encode()
+
+    async def get_nav_permission_key(self, request: Request) -> Optional[Hashable]:
+        """获取当前用户的导航菜单权限标识,例如: 用户角色id组成的frozenset.
+        权限标识相同的用户共享同一份导航菜单缓存;返回None则不过滤页面.
+        """
+        return None
+
+    def has_nav_page_permission(self, permission_key: Hashable, page: NavPage) -> bool:
+        """判断权限标识是否有页面的权限.每个权限标识的导航菜单只计算一次"""
+        return True
+
+    async def get_active_pages_content(self, permission_key: Optional[Hashable] = None) -> bytes:
+        """获取导航菜单数据,并且编码为json"""
+        is_permitted = None
+        if permission_key is not None:
+            is_permitted = functools.partial(self.has_nav_page_permission, permission_key)
+        items = await self.run_page_manager("get_db_active_pages", is_permitted=is_permitted)
+        # 将根节点的子节点提取出来
+        if items:
+            root = items[0]
+            children = items[0]["children"]
+            root["children"] = []
+            items = [root, *children, *items[1:]]
+        return JSONResponse(jsonable_encoder(BaseApiOut(data=items))).body
+
+    def _create_items(self, session: Session, items: List[Dict[str, Any]]) -> List[NavPage]:
+        AmisPageManager(session, self.page_schema_store).pack_page_schemas(items)
+        return super()._create_items(session, items)
+
+    def _read_items(self, session: Session, item_id: List[str]) -> List[Any]:
+        objs = self._fetch_item_scalars(session, item_id)
+        page_schemas = AmisPageManager(session, self.page_schema_store).load_page_schemas(objs)
+        items = [self.read_item(obj) for obj in objs]
+        for obj, item in zip(objs, items):  # 从页面配置存储中读取页面配置
+            if obj.page_schema_hash in page_schemas:
+                item.page_schema = page_schemas[obj.page_schema_hash]
+        return items
+
+    def _update_items(self, session: Session, item_id: List[str], values: Dict[str, Any]) -> List[NavPage]:
+        if "page_schema" in values:
+            values = dict(values)
+            AmisPageManager(session, self.page_schema_store).pack_page_schemas([values])
+        return super()._update_items(session, item_id, values)
+
+    async def create_items(self, request: Request, items: List[SchemaCreateT]) -> List[NavPage]:
+        objs = await super().create_items(request, items)
+        await self.on_pages_changed()
+        return objs
+
+    async def update_items(self, request: Request, item_id: List[str], values: Dict[str, Any]) -> List[NavPage]:
+        objs = await super().update_items(request, item_id, values)
+        await self.on_system_pages_changed(objs)
+        await self.run_page_manager("delete_unused_page_schemas")  # 修改或者删除后,旧的页面配置可能不再被引用
+        await self.on_pages_changed()
+        return objs
+
+    async def delete_items(self, request: Request, item_id: List[str]) -> List[NavPage]:
+        objs = await super().delete_items(request, item_id)
+        await self.on_system_pages_changed(objs)
+        await self.run_page_manager("delete_unused_page_schemas")  # 修改或者删除后,旧的页面配置可能不再被引用
+        await self.on_pages_changed()
+        return objs
+
+    async def on_system_pages_changed(self, objs: List[NavPage]):
+        """修改或者删除了系统页面时,清除记录的site指纹,下次启动时恢复系统页面的默认配置"""
+        if any(not obj.is_custom for obj in objs):
+            await self.run_page_manager("reset_site_fingerprint")
+
     async def get_create_form(self, request: Request, bulk: bool = False) -> Form:
         form = await super().get_create_form(request, bulk)
         if not bulk:
@@ -129,23 +440,74 @@ class NavPageAdmin(admin.ModelAdmin):
     async def on_create_pre(self, request: Request, obj: SchemaCreateT, **kwargs) -> Dict[str, Any]:
         data = await super().on_create_pre(request, obj, **kwargs)
         data["is_custom"] = True
-        data["parent_id"] = request.query_params.get("parent_id")  or None
+        parent_id, parent = request.query_params.get("parent_id"), None
+        if parent_id:  # 上级菜单不存在时返回错误,而不是创建一个新的根页面
+            parent = parent_id.isdigit() and await self.db.async_get(NavPage, int(parent_id))
+            if not parent:
+                raise HTTPException(status.HTTP_400_BAD_REQUEST, f"上级菜单不存在: {parent_id}")
+        data["parent_id"] = parent and parent.id
+        if parent:  # 维护路径索引
+            try:
+                data["path"], data["depth"] = check_page_path(parent.child_path, parent.id), parent.depth + 1
+            except NavTreeError as error:
+                raise HTTPException(status.HTTP_400_BAD_REQUEST, error.msg) from error
         if data.get("type") == NavPageType.Group:
             data["is_group"] = True
         return data
 
     async def get_list_table(self, request: Request) -> TableCRUD:
         table = await super().get_list_table(request)
-        table.defaultParams.update({"is_active": True})
+        table.defaultParams.update(self.list_default_filters)
         table.itemBadge = amis.Badge(
             text="Group",
             mode="ribbon",
             position="top-left",
             visibleOn="this.is_group",
         )
+        if self.list_lazy_children:
+            table.deferApi = f"get:{self.router_path}/get_children?parent_id=${{id}}"
         return table
 
+    async def get_actions(self, request: Request, flag: str) -> List[Action]:
+        actions = await super().get_actions(request, flag)
+        if flag not in ("item", "column"):
+            return actions
+        # 按树分页时,"加载更多"的行不是真实的页面,不显示行操作按钮
+        for i, action in enumerate(actions):
+            visible_on = f"!this.load_more && ({action.visibleOn})" if action.visibleOn else "!this.load_more"
+            actions[i] = action.copy(update={"visibleOn": visible_on})
+        return actions
+
+    async def on_filter_pre(self, request: Request, obj: Optional[SchemaFilterT], **kwargs) -> Dict[str, Any]:
+        data = await super().on_filter_pre(request, obj, **kwargs) or {}
+        # 按树分页时,只有使用默认筛选条件才只查询根级页面;否则不满足筛选条件的上级页面下的页面无法展开,按普通列表分页
+        if self.list_lazy_children and all(self.list_default_filters.get(key, ...) == value for key, value in data.items()):
+            data["parent_id"] = None
+            request.state.nav_lazy_children = True
+        return data
+
+    def calc_filter_clause(self, data: Dict[str, Any]) -> List[BinaryExpression]:
+        if "parent_id" in data and data["parent_id"] is None:
+            data = {key: value for key, value in data.items() if key != "parent_id"}
+            return [*super().calc_filter_clause(data), NavPage.parent_id.is_(None)]
+        return super().calc_filter_clause(data)
+
+    async def set_items_defer(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """标记存在子页面的页面,amis表格展开时通过deferApi加载子页面"""
+        ids = [item["id"] for item in items]
+        if ids:
+            stmt = select(NavPage.parent_id).where(NavPage.parent_id.in_(ids)).distinct()
+            parent_ids = set((await self.db.async_scalars(stmt)).all())
+            for item in items:
+                if item["id"] in parent_ids:
+                    item["defer"] = True
+        return items
+
     async def on_list_after(self, request: Request, result: Result, data: ItemListSchema, **kwargs) -> ItemListSchema:
         data.items = self.parser.conv_row_to_dict(result.all())
-        data.items = [self.list_item(item) for item in include_children(data.items)]
+        if getattr(request.state, "nav_lazy_children", False):
+            data.items = await self.set_items_defer(data.items)
+        elif not self.list_lazy_children:
+            data.items = include_children(data.items)
+        data.items = [self.list_item(item) for item in data.items]
         return data
@@ -0,0 +1,53 @@
+import hashlib
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class NavCache:
+    """进程内导航缓存, 以版本号为键; 数据变更时递增版本号, 旧版本缓存全部失效"""
+
+    def __init__(self, maxsize: int = 128):
+        self.version = 0
+        self.maxsize = maxsize
+        self.hits = self.misses = 0  # 命中统计
+        self._data: "OrderedDict[Tuple[int, Hashable], Any]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        cache_key = (self.version, key)
+        if cache_key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(cache_key)
+        return self._data[cache_key]
+
+    def set(self, key: Hashable, value: Any, version: Optional[int] = None) -> Any:
+        """保存缓存.version: 开始读取数据时的版本号,如果读取期间缓存已经失效,则不保存,避免旧数据缓存到新版本下"""
+        if version is not None and version != self.version:
+            return value
+        self._data[(self.version, key)] = value
+        while len(self._data) > self.maxsize:  # 超出容量,淘汰最久未使用的缓存
+            self._data.popitem(last=False)
+        return value
+
+    def invalidate(self) -> int:
+        """递增版本号,使当前缓存全部失效"""
+        self.version += 1
+        self._data.clear()
+        return self.version
+
+
+def make_etag(content: bytes) -> str:
+    """根据响应内容生成强ETag"""
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """判断请求头If-None-Match是否匹配ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match使用弱比较,忽略W/前缀.lstrip("W/")会按字符删除,不能用于去除前缀
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return etag in {tag[2:] if tag.startswith("W/") else tag for tag in tags}
@@ -0,0 +1,55 @@
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, Union
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy_database import AsyncDatabase, Database
+
+from fastapi_amis_admin_nav.models import NavPageMeta
+
+
+class BaseInvalidationChannel(ABC):
+    """页面变更通知通道.多进程部署时,用于通知其他进程页面数据已经变更.
+    每个主题对应一个递增的版本号,进程通过对比版本号判断是否需要重新同步.
+    """
+
+    @abstractmethod
+    async def publish(self, topic: str) -> int:
+        """发布变更通知,返回主题的新版本号"""
+
+    @abstractmethod
+    async def get_versions(self, topics: Iterable[str]) -> Dict[str, int]:
+        """获取主题的最新版本号"""
+
+
+class DBPollingChannel(BaseInvalidationChannel):
+    """基于数据库轮询的通知通道,版本号保存在system_page_meta表中,无需额外的外部服务"""
+
+    def __init__(self, db: Union[AsyncDatabase, Database], key_prefix: str = "version:"):
+        self.db = db
+        self.key_prefix = key_prefix
+
+    def _publish(self, session: Session, topic: str) -> int:
+        key = f"{self.key_prefix}{topic}"
+        stmt = update(NavPageMeta).where(NavPageMeta.key == key).values(version=NavPageMeta.version + 1)
+        if not session.execute(stmt).rowcount:  # 如果不存在,则创建
+            try:
+                with session.begin_nested():
+                    session.add(NavPageMeta(key=key, version=1))
+            except IntegrityError:  # 其他进程已经创建,重新递增版本号
+                session.execute(stmt)
+        return session.scalar(select(NavPageMeta.version).where(NavPageMeta.key == key))
+
+    async def publish(self, topic: str) -> int:
+        return await self.db.async_run_sync(self._publish, topic)
+
+    def _get_versions(self, session: Session, topics: Iterable[str]) -> Dict[str, int]:
+        keys = {f"{self.key_prefix}{topic}": topic for topic in topics}
+        rows = session.execute(select(NavPageMeta.key, NavPageMeta.version).where(NavPageMeta.key.in_(list(keys))))
+        versions = {topic: 0 for topic in keys.values()}
+        versions.update({keys[key]: version for key, version in rows})
+        return versions
+
+    async def get_versions(self, topics: Iterable[str]) -> Dict[str, int]:
+        return await self.db.async_run_sync(self._get_versions, topics)
@@ -1,13 +1,19 @@
+import hashlib
+import json
 import uuid
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 
 from fastapi_amis_admin import amis, models
 from fastapi_amis_admin.amis import PageSchema
-from fastapi_amis_admin.models import Field, SQLModel, ChoiceType
-from sqlalchemy import Column, Text, func
+from fastapi_amis_admin.amis.components import Iframe, Page
+from fastapi_amis_admin.models import ChoiceType, Field, SQLModel
+from sqlalchemy import Column, Index, LargeBinary, Text, func
 from sqlmodel import Relationship
 
+PATH_MAX_LENGTH = 255  # 页面路径索引的最大长度
+
 
 class NavPageType(models.IntegerChoices):
     Group = 1, "页面分组"
@@ -31,6 +37,26 @@ def parse_page_schema_type(obj: PageSchema) -> NavPageType:
         return NavPageType.Custom
 
 
+def hash_page_schema(page_schema: str) -> str:
+    """计算页面配置的内容哈希"""
+    return hashlib.sha256(page_schema.encode()).hexdigest()
+
+
+@lru_cache(maxsize=1024)
+def _parse_page_schema(page_schema: str, lazy: bool = False) -> PageSchema:
+    """解析PageSchema,按照page_schema文本缓存解析结果.
+    lazy: 不校验页面的schema,直接使用json数据构造,在页面渲染时原样输出.
+    """
+    if not lazy:
+        return PageSchema.parse_raw(page_schema)
+    data = json.loads(page_schema)
+    schema = data.pop("schema", None)
+    page = PageSchema.parse_obj(data)
+    if isinstance(schema, dict):
+        page.schema_ = Iframe.construct(**schema) if schema.get("type") == "iframe" else Page.construct(**schema)
+    return page
+
+
 class BaseNavPage(SQLModel):
     id: Optional[int] = Field(default=None, primary_key=True, nullable=False)
     type: NavPageType = Field(NavPageType.Custom, title="页面类型", sa_type=ChoiceType(NavPageType))
@@ -69,8 +95,11 @@ class BaseNavPage(SQLModel):
         sa_column=Column(Text, nullable=False),
         amis_form_item=amis.Editor(language="json"),
         amis_table_column=amis.TableColumn(type="json"),
-    )  # 如果是菜单组, 则没有page_schema;如果是普通html页面,则是schema
+    )  # 如果是菜单组, 则没有page_schema;如果是普通html页面,则是schema.启用页面配置存储时为空,配置保存在system_page_schema
+    page_schema_hash: Optional[str] = Field(None, title="页面配置哈希", max_length=64)
     parent_id: Optional[int] = Field(None, title="上级菜单", foreign_key="system_page.id")
+    path: str = Field("/", title="页面路径索引", max_length=PATH_MAX_LENGTH, index=True)  # 所有上级页面的id,例如: /1/4/
+    depth: int = Field(0, title="页面层级")
     unique_id: str = Field(
         default_factory=lambda: str(uuid.uuid4()).replace("-", "")[:16],
         title="标识",
@@ -97,8 +126,12 @@ class BaseNavPage(SQLModel):
         sa_column_kwargs={"onupdate": func.now(), "server_default": func.now()},
     )
 
-    def as_page_schema(self) -> PageSchema:
-        page = PageSchema.parse_raw(self.page_schema)
+    def as_page_schema(self, lazy: bool = False, page_schema: str = None) -> PageSchema:
+        """转换为PageSchema.
+        lazy: 是否延迟校验页面的schema,适用于仅在渲染时才需要完整schema的场景.
+        page_schema: 从页面配置存储中读取的配置,默认使用page_schema字段
+        """
+        page = _parse_page_schema(page_schema or self.page_schema or "{}", lazy).copy()  # 浅复制,避免修改缓存
         page.label = self.label or page.label
         page.icon = self.icon or page.icon
         page.url = self.url or page.url or f"/{self.unique_id}"
@@ -115,8 +148,7 @@ class BaseNavPage(SQLModel):
         return cls(**data).update_from_page_schema(obj)
 
     def update_from_page_schema(self, obj: PageSchema):
-        """从PageSchema更新数据"""
-        update = False
+        """从PageSchema更新数据,只修改发生变化的字段;页面配置通过哈希对比是否变化"""
         for key in ("label", "icon", "url", "visible", "tabsMode"):
             value = getattr(obj, key)
             if value is None and key in ("visible",):
@@ -124,12 +156,21 @@ class BaseNavPage(SQLModel):
             if getattr(self, key) == value:
                 continue
             setattr(self, key, value)
-            update = True
-        if update:
-            self.page_schema = obj.amis_json()
-            self.type = parse_page_schema_type(obj)
+        page_schema = obj.amis_json()
+        page_schema_hash = hash_page_schema(page_schema)
+        if self.page_schema_hash != page_schema_hash:
+            self.page_schema = page_schema
+            self.page_schema_hash = page_schema_hash
+        page_type = parse_page_schema_type(obj)
+        if self.type != page_type:
+            self.type = page_type
         return self
 
+    @property
+    def child_path(self) -> str:
+        """子页面的路径索引"""
+        return f"{self.path}{self.id}/"
+
     def as_nav_link(self) -> amis.Nav.Link:
         link = amis.Nav.Link(
             label=self.label,
@@ -144,6 +185,10 @@ class BaseNavPage(SQLModel):
 
 class NavPage(BaseNavPage, table=True):
     __tablename__ = "system_page"
+    __table_args__ = (
+        Index("ix_system_page_parent_id_sort", "parent_id", "sort"),
+        Index("ix_system_page_is_active_visible_sort", "is_active", "visible", "sort"),
+    )
 
     parent: Optional["NavPage"] = Relationship(
         sa_relationship_kwargs={
@@ -158,3 +203,28 @@ class NavPage(BaseNavPage, table=True):
     #         backref=backref("parent", uselist=True, remote_side="NavPage.id"),
     #     ),
     # )
+
+
+class NavPageMeta(SQLModel, table=True):
+    """页面管理的元数据,例如: 页面版本号"""
+
+    __tablename__ = "system_page_meta"
+
+    key: str = Field(..., title="键", primary_key=True, max_length=50)
+    value: str = Field("", title="值", sa_column=Column(Text, nullable=False))
+    version: int = Field(0, title="版本号")
+    update_time: Optional[datetime] = Field(
+        default_factory=datetime.now,
+        title="更新时间",
+        sa_column_kwargs={"onupdate": func.now(), "server_default": func.now()},
+    )
+
+
+class NavPageSchema(SQLModel, table=True):
+    """页面配置存储,按内容哈希去重,相同的页面配置只保存一份"""
+
+    __tablename__ = "system_page_schema"
+
+    hash: str = Field(..., title="配置哈希", primary_key=True, max_length=64)
+    data: bytes = Field(b"", title="配置数据", sa_column=Column(LargeBinary, nullable=False))
+    compressed: bool = Field(False, title="是否压缩")
@@ -0,0 +1,90 @@
+import zlib
+from typing import Any, Dict, Iterable, List, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from fastapi_amis_admin_nav.cache import NavCache
+from fastapi_amis_admin_nav.models import NavPage, NavPageSchema, hash_page_schema
+
+
+class PageSchemaStore:
+    """页面配置存储.按内容哈希保存页面配置,相同的配置只保存一份,页面只记录配置的哈希.
+    compress_min_size: 配置超过该字节数时使用zlib压缩保存,为0则不压缩
+    cache_size: 进程内缓存的配置数量;配置按哈希寻址,内容不会变化,缓存无需失效
+    auto_delete: 同步,导入或者修改页面后,自动删除没有页面引用的配置
+    """
+
+    def __init__(self, compress_min_size: int = 512, cache_size: int = 1024, chunk_size: int = 500, auto_delete: bool = True):
+        self.compress_min_size = compress_min_size
+        self.chunk_size = chunk_size
+        self.auto_delete = auto_delete
+        self.cache = NavCache(maxsize=cache_size)
+
+    def encode(self, page_schema: str) -> Tuple[bytes, bool]:
+        data = page_schema.encode()
+        if self.compress_min_size and len(data) >= self.compress_min_size:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                return compressed, True
+        return data, False
+
+    @staticmethod
+    def decode(data: bytes, compressed: bool) -> str:
+        return (zlib.decompress(data) if compressed else data).decode()
+
+    def put_many(self, session: Session, page_schemas: Iterable[str]) -> List[str]:
+        """保存页面配置,已经存在的配置不重复保存,返回配置的哈希"""
+        page_schemas = list(page_schemas)
+        hashes = [hash_page_schema(page_schema) for page_schema in page_schemas]
+        missing = dict(zip(hashes, page_schemas))
+        for hash_ in self._get_existing(session, missing):
+            missing.pop(hash_)
+        if missing:
+            try:
+                with session.begin_nested():
+                    session.add_all(NavPageSchema(hash=hash_, **self._encode_fields(text)) for hash_, text in missing.items())
+            except IntegrityError:  # 其他进程同时写入了相同的配置,只写入仍然不存在的配置
+                for hash_ in self._get_existing(session, missing):
+                    missing.pop(hash_)
+                session.add_all(NavPageSchema(hash=hash_, **self._encode_fields(text)) for hash_, text in missing.items())
+                session.flush()
+        for hash_, page_schema in zip(hashes, page_schemas):
+            self.cache.set(hash_, page_schema)
+        return hashes
+
+    def get_many(self, session: Session, hashes: Iterable[str]) -> Dict[str, str]:
+        """按哈希读取页面配置,返回{哈希: 配置}"""
+        result: Dict[str, str] = {}
+        missing: List[str] = []
+        for hash_ in set(hashes):
+            page_schema = self.cache.get(hash_)
+            if page_schema is None:
+                missing.append(hash_)
+            else:
+                result[hash_] = page_schema
+        for start in range(0, len(missing), self.chunk_size):
+            end = start + self.chunk_size
+            stmt = select(NavPageSchema).where(NavPageSchema.hash.in_(missing[start:end]))
+            for item in session.scalars(stmt):
+                result[item.hash] = self.cache.set(item.hash, self.decode(item.data, item.compressed))
+        return result
+
+    def delete_unused(self, session: Session) -> int:
+        """删除没有页面引用的配置,返回删除的数量"""
+        used = select(NavPage.page_schema_hash).where(NavPage.page_schema_hash.is_not(None))
+        return session.execute(delete(NavPageSchema).where(NavPageSchema.hash.not_in(used))).rowcount
+
+    def _encode_fields(self, page_schema: str) -> Dict[str, Any]:
+        data, compressed = self.encode(page_schema)
+        return {"data": data, "compressed": compressed}
+
+    def _get_existing(self, session: Session, hashes: Iterable[str]) -> List[str]:
+        hashes = list(hashes)
+        existing: List[str] = []
+        for start in range(0, len(hashes), self.chunk_size):
+            end = start + self.chunk_size
+            stmt = select(NavPageSchema.hash).where(NavPageSchema.hash.in_(hashes[start:end]))
+            existing.extend(session.scalars(stmt))
+        return existing
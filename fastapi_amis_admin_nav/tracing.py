@@ -0,0 +1,107 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from fastapi_amis_admin_nav.models import _parse_page_schema
+
+_current_report: ContextVar[Optional["TraceReport"]] = ContextVar("nav_trace_report", default=None)
+
+
+class TraceReport:
+    """一次页面管理操作的统计报告"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start_time = datetime.now()
+        self.duration = 0.0  # 耗时,单位秒
+        self.sql_count = 0  # 执行的SQL语句数量
+        self.phases: List[Dict[str, Any]] = []  # 各阶段的统计,按完成的先后顺序
+        self.caches: Dict[str, Dict[str, Any]] = {}  # 各缓存的命中统计
+        self.error: Optional[str] = None
+        self._phase: Optional[Dict[str, Any]] = None  # 当前正在执行的阶段
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "start_time": self.start_time.isoformat(),
+            "duration": self.duration,
+            "sql_count": self.sql_count,
+            "phases": self.phases,
+            "caches": self.caches,
+            "error": self.error,
+        }
+
+
+@contextmanager
+def trace_phase(name: str) -> Iterator[Dict[str, Any]]:
+    """记录当前操作中一个阶段的耗时和SQL语句数量.可以设置返回字典的rows,记录处理的行数.
+    没有开启追踪时,不做任何统计.
+    """
+    report = _current_report.get()
+    if report is None:
+        yield {}
+        return
+    parent = report._phase
+    phase = {"name": name, "parent": parent and parent["name"], "duration": 0.0, "sql_count": 0, "rows": None}
+    report._phase = phase
+    sql_count, start = report.sql_count, time.perf_counter()
+    try:
+        yield phase
+    finally:
+        phase["duration"] = round(time.perf_counter() - start, 6)
+        phase["sql_count"] = report.sql_count - sql_count
+        report._phase = parent
+        report.phases.append(phase)
+
+
+def _count_statement(*args, **kwargs):
+    report = _current_report.get()
+    if report is not None:
+        report.sql_count += 1
+
+
+class NavTracer:
+    """页面管理操作的追踪器,保存最近maxlen次操作的统计报告.
+    通过contextvars关联当前操作,只统计当前操作执行的SQL语句,不受并发请求的影响.
+    """
+
+    def __init__(self, maxlen: int = 20):
+        self.reports: Deque[TraceReport] = deque(maxlen=maxlen)
+        # 缓存名称 -> 获取(命中次数, 未命中次数)的函数
+        self.caches: Dict[str, Callable[[], Tuple[int, int]]] = {
+            "parse_page_schema": lambda: tuple(_parse_page_schema.cache_info())[:2],
+        }
+        if not event.contains(Engine, "before_cursor_execute", _count_statement):
+            event.listen(Engine, "before_cursor_execute", _count_statement)
+
+    @contextmanager
+    def trace(self, name: str) -> Iterator[TraceReport]:
+        """追踪一次操作,结束后保存统计报告.在已经追踪的操作中调用时,作为当前操作的一个阶段"""
+        current = _current_report.get()
+        if current is not None:
+            with trace_phase(name):
+                yield current
+            return
+        report = TraceReport(name)
+        caches = {key: get_info() for key, get_info in self.caches.items()}
+        token = _current_report.set(report)
+        start = time.perf_counter()
+        try:
+            yield report
+        except Exception as e:
+            report.error = repr(e)
+            raise
+        finally:
+            report.duration = round(time.perf_counter() - start, 6)
+            _current_report.reset(token)
+            for key, get_info in self.caches.items():  # 缓存命中统计包含同一时间其他请求的访问
+                hits, misses = (now - before for now, before in zip(get_info(), caches[key]))
+                total = hits + misses
+                report.caches[key] = {"hits": hits, "misses": misses, "hit_rate": round(hits / total, 4) if total else None}
+            self.reports.append(report)
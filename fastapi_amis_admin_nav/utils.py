@@ -1,30 +1,190 @@
+import hashlib
+import json
 from functools import cached_property
-from typing import Dict, List, Optional
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from fastapi_amis_admin.admin.admin import AdminGroup, PageSchemaAdmin
+from fastapi_amis_admin.amis import PageSchema
+from sqlalchemy import and_, inspect, literal, or_, text, update
+from sqlalchemy.engine import Connection, Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import Session
 
-from fastapi_amis_admin_nav.models import NavPage
+from fastapi_amis_admin_nav import __version__
+from fastapi_amis_admin_nav.models import (
+    PATH_MAX_LENGTH,
+    NavPage,
+    NavPageMeta,
+    hash_page_schema,
+)
+from fastapi_amis_admin_nav.schema_store import PageSchemaStore
+from fastapi_amis_admin_nav.tracing import trace_phase
+
+PAGE_SORT_COLUMNS = (NavPage.id, NavPage.parent_id, NavPage.sort, NavPage.is_group, NavPage.path, NavPage.depth)
+ACTIVE_PAGES_STMT = select(NavPage).where(NavPage.is_active == True, NavPage.visible == True).order_by(NavPage.sort.desc())
+SITE_FINGERPRINT_KEY = "site_fingerprint"  # 记录site指纹的元数据键
+# 清除记录的site指纹,下次启动时重新同步site和数据库
+RESET_SITE_FINGERPRINT_STMT = update(NavPageMeta).where(NavPageMeta.key == SITE_FINGERPRINT_KEY).values(value="")
+EXPORT_EXCLUDE = {"id", "parent_id", "path", "depth", "page_schema_hash", "update_time"}  # 导出页面时排除的字段
+# 默认最大层级由路径索引的列宽推算: 页面id不超过7位时,每一级最多占8个字符,路径索引不会超出列宽
+DEFAULT_MAX_DEPTH = PATH_MAX_LENGTH // 8
+
+
+class NavTreeError(ValueError):
+    """菜单树结构错误.
+    code: cycle 父级关系形成环; duplicate 页面重复出现; max_depth 层级超过最大深度; missing_parent 上级菜单不存在
+    """
+
+    def __init__(self, code: str, msg: str, page: Any = None):
+        super().__init__(code, msg, page)
+        self.code = code
+        self.msg = msg
+        self.page = page  # 出错的页面,unique_id或者id
+
+    def __str__(self) -> str:
+        return self.msg
+
+    def dict(self) -> Dict[str, Any]:
+        return {"code": self.code, "page": self.page}
+
+    @classmethod
+    def cycle(cls, page: Any) -> "NavTreeError":
+        return cls("cycle", f"页面的上级菜单形成了循环: {page}", page)
+
+    @classmethod
+    def duplicate(cls, page: Any) -> "NavTreeError":
+        return cls("duplicate", f"页面重复出现: {page}", page)
+
+    @classmethod
+    def max_depth(cls, page: Any, max_depth: int) -> "NavTreeError":
+        return cls("max_depth", f"页面层级超过最大深度{max_depth}: {page}", page)
+
+    @classmethod
+    def missing_parent(cls, page: Any) -> "NavTreeError":
+        return cls("missing_parent", f"页面的上级菜单不存在: {page}", page)
+
+    @classmethod
+    def path_length(cls, page: Any) -> "NavTreeError":
+        return cls("max_depth", f"页面路径索引超过最大长度{PATH_MAX_LENGTH},请减少菜单层级: {page}", page)
+
+
+def pages_chunk_stmt(after: Tuple[int, int], limit: int):
+    depth, id_ = after
+    return (
+        select(NavPage)
+        .where(or_(NavPage.depth > depth, and_(NavPage.depth == depth, NavPage.id > id_)))
+        .order_by(NavPage.depth, NavPage.id)
+        .limit(limit)
+    )
+
+
+class SiteMenuPlan:
+    """site菜单的变更.计算时不修改site,发布时一次性替换各分组的子页面列表和页面的page_schema"""
+
+    def __init__(self):
+        self.children: Dict[int, Tuple[AdminGroup, List[PageSchemaAdmin]]] = {}  # id(分组) -> (分组, 新的子页面列表)
+        self.page_schemas: List[Tuple[PageSchemaAdmin, PageSchema]] = []
+
+    def get_children(self, group: AdminGroup) -> List[PageSchemaAdmin]:
+        """获取分组新的子页面列表,第一次修改时复制原列表"""
+        item = self.children.get(id(group))
+        if item is None:
+            item = self.children[id(group)] = (group, list(group))
+        return item[1]
+
+    def publish(self):
+        """发布变更.只替换引用,不修改原有的列表;期间没有await,在事件循环中调用时不会与渲染菜单的请求交错"""
+        for admin, page_schema in self.page_schemas:
+            admin.page_schema = page_schema
+        for group, children in self.children.values():
+            group._children = children
 
 
 class AmisPageManager:
+    lazy_page_schema: bool = True  # 同步到site时,是否延迟校验页面的schema
 
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, schema_store: PageSchemaStore = None, max_depth: int = DEFAULT_MAX_DEPTH):
         self.session = session
+        self.schema_store = schema_store  # 页面配置存储,为空则页面配置保存在page_schema字段中
+        self.max_depth = max_depth  # 菜单的最大层级,超过则抛出NavTreeError
 
     @cached_property
     def db_pages(self) -> List[NavPage]:
-        return self.session.scalars(select(NavPage)).all()
+        with trace_phase("load_pages") as phase:
+            pages = self.session.scalars(select(NavPage)).all()
+            phase["rows"] = len(pages)
+        return pages
 
     @cached_property
     def db_pages_uid_map(self) -> Dict[str, NavPage]:
         return {page.unique_id: page for page in self.db_pages}
 
     @cached_property
-    def db_pages_id_map(self) -> Dict[str, NavPage]:
+    def db_pages_id_map(self) -> Dict[int, NavPage]:
         return {page.id: page for page in self.db_pages}
 
+    @cached_property
+    def db_page_schemas(self) -> Dict[str, str]:
+        return self.load_page_schemas(self.db_pages_id_map.values())
+
+    def load_page_schemas(self, pages: Iterable[NavPage]) -> Dict[str, str]:
+        """从页面配置存储中读取页面配置,只读取page_schema字段为空的页面,返回{哈希: 配置}"""
+        hashes = {page.page_schema_hash for page in pages if not page.page_schema and page.page_schema_hash}
+        if not hashes:
+            return {}
+        with trace_phase("load_page_schemas") as phase:
+            phase["rows"] = len(hashes)
+            return (self.schema_store or PageSchemaStore()).get_many(self.session, hashes)
+
+    def as_page_schema(self, page: NavPage) -> PageSchema:
+        return page.as_page_schema(lazy=self.lazy_page_schema, page_schema=self.db_page_schemas.get(page.page_schema_hash))
+
+    def pack_page_schemas(self, pages: Iterable[Union[NavPage, dict]]) -> None:
+        """记录页面配置的哈希.启用页面配置存储时,将配置移入存储,page_schema字段置空;
+        未启用时,将之前移入存储的配置恢复到page_schema字段.
+        pages: NavPage对象或者页面数据字典
+        """
+
+        def get_value(page: Union[NavPage, dict], key: str) -> Any:
+            return page.get(key) if isinstance(page, dict) else getattr(page, key)
+
+        def set_value(page: Union[NavPage, dict], key: str, value: Any):
+            if isinstance(page, dict):
+                page[key] = value
+            elif getattr(page, key) != value:  # 只修改变化的字段
+                setattr(page, key, value)
+
+        if self.schema_store:
+            pages = [page for page in pages if get_value(page, "page_schema")]
+            hashes = self.schema_store.put_many(self.session, [get_value(page, "page_schema") for page in pages])
+            for page, hash_ in zip(pages, hashes):
+                set_value(page, "page_schema", "")
+                set_value(page, "page_schema_hash", hash_)
+            return
+        restore = []
+        for page in pages:
+            if get_value(page, "page_schema"):
+                set_value(page, "page_schema_hash", hash_page_schema(get_value(page, "page_schema")))
+            elif get_value(page, "page_schema") == "" and get_value(page, "page_schema_hash"):
+                restore.append(page)
+        page_schemas = PageSchemaStore().get_many(self.session, [get_value(page, "page_schema_hash") for page in restore])
+        for page in restore:
+            set_value(page, "page_schema", page_schemas.get(get_value(page, "page_schema_hash"), "{}"))
+
     @cached_property
     def site_page(self) -> Optional[NavPage]:
         """获取根节点,有且只有一个"""
@@ -34,12 +194,12 @@ class AmisPageManager:
         return None
 
     def site_to_db(self, admin_group: AdminGroup, parent_id: int = None):
-        """将site对象的菜单页面同步的数据库中"""
-        for page in self.db_pages:
-            if not page.is_custom:  # 如果不是自定义的,则先全部设置为未激活
-                page.is_active = False
+        """将site对象的菜单页面同步的数据库中.
+        先计算出最终的激活状态和页面配置,只修改发生变化的字段,未变化的页面不会产生UPDATE,也不会刷新update_time
+        """
+        active_ids: Set[int] = set()  # site中存在的页面
 
-        def append_page_to_db(admin_: PageSchemaAdmin) -> Optional[int]:
+        def append_page_to_db(admin_: PageSchemaAdmin, parent_id_: Optional[int]) -> Optional[int]:
             """将页面添加到数据库中"""
             if not admin_.page_schema:  # 如果不存在page_schema,则不保存到数据库
                 return None
@@ -47,61 +207,163 @@ class AmisPageManager:
             page = self.db_pages_uid_map.get(unique_id)
             # print('unique_id', unique_id, page)
             if page:  # 如果存在数据库中,则读取数据库中设置,并且更新到admin
-                page.is_active = True  # 设置为激活
+                active_ids.add(page.id)
                 if not page.is_locked:  # 判断是否锁定,如果锁定,则不更新.
                     page.update_from_page_schema(admin_.page_schema)
                 return page.id
             # 保存到数据库
+            parent = self.db_pages_id_map.get(parent_id_) if parent_id_ else None
             kwargs = {
                 "label": admin_.page_schema.label,
                 "sort": admin_.page_schema.sort,
-                "parent_id": parent_id,
+                "parent_id": parent_id_,
                 "unique_id": unique_id,
+                "path": check_page_path(parent.child_path, unique_id) if parent else "/",
+                "depth": parent.depth + 1 if parent else 0,
             }
             if isinstance(admin_, AdminGroup):
                 kwargs["is_group"] = True
             new_page = NavPage(**kwargs).update_from_page_schema(admin_.page_schema)
             self.session.add(new_page)
             self.session.flush()  # 刷新,获取page_id
+            self.db_pages_id_map[new_page.id] = new_page
+            self.db_pages_uid_map[new_page.unique_id] = new_page
+            active_ids.add(new_page.id)
             return new_page.id
 
         if not parent_id:  # 如果没有parent_id,则作为根节点添加到数据库中,并且获取parent_id
             if not self.site_page:
-                parent_id = append_page_to_db(admin_group)
+                parent_id = append_page_to_db(admin_group, None)
             else:
-                self.site_page.is_active = True
-                self.site_page.unique_id = admin_group.unique_id
+                if self.site_page.unique_id != admin_group.unique_id:
+                    self.site_page.unique_id = admin_group.unique_id
                 parent_id = self.site_page.id
-        for admin in admin_group:
-            page_id = append_page_to_db(admin)
+        site_page_id = parent_id
+        active_ids.add(parent_id)
+        # 使用显式栈先序遍历,与递归的顺序一致
+        stack: List[Tuple[AdminGroup, Iterator[PageSchemaAdmin], Optional[int]]] = [(admin_group, iter(admin_group), parent_id)]
+        while stack:
+            group, children, group_id = stack[-1]
+            admin = next(children, None)
+            if admin is None:
+                stack.pop()
+                continue
+            if len(stack) >= self.max_depth:  # 页面的层级即为栈的深度
+                raise NavTreeError.max_depth(admin.unique_id, self.max_depth)
+            page_id = append_page_to_db(admin, group_id)
             if isinstance(admin, AdminGroup):
-                self.site_to_db(admin, page_id)
+                if any(item[0] is admin for item in stack):
+                    raise NavTreeError.cycle(admin.unique_id)
+                stack.append((admin, iter(admin), page_id or site_page_id))  # 没有page_schema的分组,子页面添加到根节点
+        for page in self.db_pages:  # 只修改激活状态发生变化的页面,自定义页面保持不变
+            if not page.is_custom and page.is_active != (page.id in active_ids):
+                page.is_active = page.id in active_ids
 
         return self
 
+    def sync_site(self, admin_group: AdminGroup, fingerprint: str = None) -> bool:
+        """同步site和数据库.如果site指纹和数据库中记录的一致,则跳过写入数据库,只同步到site.
+        多进程同时启动时,通过锁定指纹记录,保证只有一个进程写入数据库.
+        返回是否写入了数据库.
+        """
+        fingerprint = fingerprint or site_fingerprint(admin_group)
+        if self.schema_store:  # 启用或者停用页面配置存储后,重新同步一次
+            fingerprint = f"{fingerprint}:store"
+        key = SITE_FINGERPRINT_KEY
+        meta = self.session.get(NavPageMeta, key)
+        if meta and meta.value == fingerprint:
+            self.db_to_site(admin_group)
+            return False
+        # 加锁后重新读取,刷新identity map中已经加载的旧值,否则等待锁的进程看不到其他进程写入的指纹
+        locked_stmt = select(NavPageMeta).where(NavPageMeta.key == key).with_for_update()
+        locked_stmt = locked_stmt.execution_options(populate_existing=True)
+        meta = self.session.scalar(locked_stmt)
+        if meta is None:
+            try:
+                with self.session.begin_nested():
+                    meta = NavPageMeta(key=key)
+                    self.session.add(meta)
+            except IntegrityError:  # 其他进程已经创建,等待其完成写入
+                meta = self.session.scalar(locked_stmt)
+        if meta.value == fingerprint:  # 其他进程已经完成写入
+            self.db_to_site(admin_group)
+            return False
+        with trace_phase("site_to_db") as phase:
+            self.site_to_db(admin_group)
+            phase["rows"] = len(self.db_pages_id_map)
+        with trace_phase("pack_page_schemas"):
+            self.pack_page_schemas(self.db_pages_id_map.values())
+        self.delete_unused_page_schemas()
+        self.rebuild_pages_path()
+        meta.value = fingerprint
+        self.db_to_site(admin_group)
+        return True
+
+    def reset_site_fingerprint(self):
+        """数据库中的系统页面被修改或者删除后调用,下次启动时重新同步,恢复系统页面的默认配置"""
+        self.session.execute(RESET_SITE_FINGERPRINT_STMT)
+
     def db_to_site(self, admin_group: AdminGroup):
         """将数据库中的菜单页面页面同步到site中"""
+        self.plan_db_to_site(admin_group).publish()
+        return self
 
-        def append_page_to_site(page_: NavPage, admin_: PageSchemaAdmin = None) -> Optional[PageSchemaAdmin]:
-            """添加子级菜单"""
-            group = admin_group
-            if page_.parent_id:
-                if page_.parent.unique_id == admin_group.unique_id:  # 如果父级是根级,则直接添加
+    def plan_db_to_site(self, admin_group: AdminGroup) -> "SiteMenuPlan":
+        """计算数据库中的菜单页面同步到site的变更.只读取site,不修改site,通过返回的SiteMenuPlan发布变更"""
+        plan = SiteMenuPlan()
+        with trace_phase("check_tree"):
+            items = [{"id": page.id, "parent_id": page.parent_id, "unique_id": page.unique_id} for page in self.db_pages]
+            check_tree(items, max_depth=self.max_depth)
+        with trace_phase("index_admin_group") as phase:
+            admin_index = index_admin_group(admin_group)  # unique_id -> (admin, 父级)
+            phase["rows"] = len(admin_index)
+
+        def find_group(page_: NavPage) -> Optional[PageSchemaAdmin]:
+            """查找页面在site中的父级.如果父级不存在,则沿父级关系向上查找,并且先依次添加父级"""
+            ancestors: List[NavPage] = []  # 不存在于site中的父级,由近到远
+            visited = {page_.id}
+            # 从已加载的页面中获取父级,避免逐条懒加载parent关系
+            parent_page = self.db_pages_id_map.get(page_.parent_id) if page_.parent_id else None
+            while parent_page:
+                if parent_page.unique_id == admin_group.unique_id:  # 如果父级是根级,则直接添加
                     group = admin_group
-                else:  # 如果父级不是根级,则先查找父级
-                    group, _ = admin_group.get_page_schema_child(page_.parent.unique_id)
-                if not group:  # 如果父级不存在,则不添加; 尝试先添加父级
-                    group = update_page_to_site(page_.parent)
-            if not group:
+                    break
+                group, _ = admin_index.get(parent_page.unique_id, (None, None))
+                if group:
+                    break
+                if parent_page.id in visited:
+                    raise NavTreeError.cycle(parent_page.unique_id)
+                if len(ancestors) >= self.max_depth:
+                    raise NavTreeError.max_depth(page_.unique_id, self.max_depth)
+                visited.add(parent_page.id)
+                if parent_page.parent_id is None:  # 根级与site不一致,则不添加
+                    return None
+                if not parent_page.is_custom:  # 如果不存在,并且不是自定义,则标记为未激活
+                    parent_page.is_active = False
+                if not (parent_page.is_active and parent_page.visible):  # 父级不存在,并且未激活,则不添加
+                    return None
+                ancestors.append(parent_page)
+                parent_page = self.db_pages_id_map.get(parent_page.parent_id)
+            else:  # 没有父级,或者父级不存在于数据库中,则添加到根级
+                group = admin_group
+            for ancestor in reversed(ancestors):  # 由远到近添加父级
+                group = add_page_to_group(ancestor, group)
+            return group
+
+        def add_page_to_group(page_: NavPage, group: Optional[PageSchemaAdmin], admin_: PageSchemaAdmin = None):
+            """添加子级菜单"""
+            if not group or not isinstance(group, AdminGroup):
                 return None
             if not admin_:
                 admin_ = AdminGroup(group.app) if page_.is_group else PageSchemaAdmin(group.app)
-                admin_.page_schema = page_.as_page_schema()
+                admin_.page_schema = self.as_page_schema(page_)
                 setattr(admin_, "unique_id", page_.unique_id)  # noqa: B010
-            if group and isinstance(group, AdminGroup):
-                group.append_child(admin_)
-                return admin_
-            return None
+            plan.get_children(group).append(admin_)
+            admin_index[admin_.unique_id] = (admin_, group)
+            return admin_
+
+        def append_page_to_site(page_: NavPage, admin_: PageSchemaAdmin = None) -> Optional[PageSchemaAdmin]:
+            return add_page_to_group(page_, find_group(page_), admin_)
 
         def update_page_to_site(page_: NavPage) -> Optional[PageSchemaAdmin]:
             """更新菜单"""
@@ -111,16 +373,18 @@ class AmisPageManager:
                 admin, parent = admin_group, None
                 page_.visible = True  # 标记为可见
             else:
-                admin, parent = admin_group.get_page_schema_child(page_.unique_id)
+                admin, parent = admin_index.get(page_.unique_id, (None, None))
             if admin:  # 如果存在,则更新
                 # print("admin 查找到Admin成功", page.unique_id, page.as_page_schema().amis_dict())
                 page_.is_active = True  # 将数据库标记为已激活
-                admin.page_schema = page_.as_page_schema()
+                plan.page_schemas.append((admin, self.as_page_schema(page_)))
                 # 对比admin中的父级是否和数据库中的一致,不一致则更新
-                if page_.parent_id and parent.unique_id != page_.parent.unique_id:  # 如果不是根级,并且父级不一致,则更新父级
+                parent_page = self.db_pages_id_map.get(page_.parent_id) if page_.parent_id else None
+                if parent_page and parent.unique_id != parent_page.unique_id:  # 如果不是根级,并且父级不一致,则更新父级
                     # print('父级不一致', parent.unique_id, admin.unique_id)
                     # 1. 先从原来的父级中删除
-                    parent.remove_child(admin.unique_id)
+                    children = plan.get_children(parent)
+                    children[:] = [child for child in children if child is not admin]
                     # 2. 再添加到新的父级中
                     return append_page_to_site(page_, admin)
             elif page_.is_active and page_.visible:  # 如果不存在,并且是激活的,则添加到site
@@ -128,64 +392,447 @@ class AmisPageManager:
                 return append_page_to_site(page_)
             return None
 
-        for page in self.db_pages:
-            update_page_to_site(page)
+        with trace_phase("update_site") as phase:
+            for page in self.db_pages:
+                update_page_to_site(page)
+            phase["rows"] = len(self.db_pages)
 
-        return self
+        return plan
 
-    def update_db_pages_parent_and_sort(self, links: List[dict], parent_id: int = None):
-        """更新数据库中菜单页面的排序和父级关系
+    def update_db_pages_parent_and_sort(self, links: List[dict], parent_id: int = None) -> int:
+        """更新数据库中菜单页面的排序和父级关系,仅批量更新发生变化的页面,返回更新的页面数量
         links: amis的导航菜单数据.结构: amis.Nav.Link
         """
-        for i, link in enumerate(links):
-            page = self.db_pages_id_map.get(link["value"])
-            if not page:
+        with trace_phase("load_rows") as phase:
+            rows = self.session.execute(select(*PAGE_SORT_COLUMNS)).all()  # 只查询需要的字段,不加载ORM对象
+            phase["rows"] = len(rows)
+        with trace_phase("calc_pages_parent_and_sort") as phase:
+            changed = calc_pages_parent_and_sort(rows, links, parent_id, self.max_depth)
+            phase["rows"] = len(changed)
+        if changed:
+            with trace_phase("update_pages"):
+                self.session.execute(update(NavPage), changed)  # 按主键批量更新
+        return len(changed)
+
+    def get_pages_chunk(self, after: Tuple[int, int] = (-1, 0), limit: int = 1000) -> List[NavPage]:
+        """按(depth, id)顺序分批查询页面,上级页面总是在下级页面之前.
+        after: 上一批最后一个页面的(depth, id)
+        """
+        return self.session.scalars(pages_chunk_stmt(after, limit)).all()
+
+    def import_pages(self, pages: List[dict], batch_size: int = 1000) -> int:
+        """按unique_id批量导入页面,存在则更新,不存在则创建,返回导入的页面数量.
+        pages: 导出的页面数据,上级页面通过parent_unique_id关联,上级页面必须在导入数据或者数据库中.
+        只有一个顶级页面,并且是导出时的根页面时,合并到当前的根页面;否则顶级页面按unique_id导入.
+        """
+        columns = set(NavPage.__table__.columns.keys()) - EXPORT_EXCLUDE
+        ids: Dict[str, int] = dict(self.session.execute(select(NavPage.unique_id, NavPage.id)).all())
+        site_page_id = self.session.scalar(select(NavPage.id).where(NavPage.parent_id.is_(None)).order_by(NavPage.id).limit(1))
+        unique_ids: Set[str] = set()
+        for page in pages:
+            if page["unique_id"] in unique_ids:
+                raise NavTreeError.duplicate(page["unique_id"])
+            unique_ids.add(page["unique_id"])
+        for page in pages:
+            parent_unique_id = page.get("parent_unique_id")
+            if parent_unique_id and parent_unique_id not in unique_ids and parent_unique_id not in ids:
+                raise NavTreeError.missing_parent(page["unique_id"])
+        roots = [page for page in pages if not page.get("parent_unique_id")]
+        merge_root = len(roots) == 1 and roots[0].get("site_root") and site_page_id and roots[0]["unique_id"]
+        # 按层级分组,保证先导入上级页面
+        items = [{"unique_id": page["unique_id"], "parent_id": page.get("parent_unique_id"), "page": page} for page in pages]
+        levels = [[item["page"] for item in level] for level in check_tree(items, key="unique_id", max_depth=self.max_depth)]
+        for depth, level in enumerate(levels):
+            with trace_phase(f"import_level_{depth}") as phase:
+                phase["rows"] = len(level)
+                new_pages: List[NavPage] = []
+                updates: List[dict] = []
+                level_data = [{key: value for key, value in page.items() if key in columns} for page in level]
+                self.pack_page_schemas(level_data)
+                for page, data in zip(level, level_data):
+                    if page["unique_id"] == merge_root:  # 合并到当前的根页面,保留根页面的unique_id
+                        data.pop("unique_id")
+                        updates.append({**data, "id": site_page_id})
+                        ids[page["unique_id"]] = site_page_id
+                        continue
+                    parent_unique_id = page.get("parent_unique_id")
+                    data["parent_id"] = ids[parent_unique_id] if parent_unique_id else None
+                    if page["unique_id"] in ids:
+                        updates.append({**data, "id": ids[page["unique_id"]]})
+                    else:
+                        new_pages.append(NavPage(**data))
+                for start in range(0, len(new_pages), batch_size):
+                    end = start + batch_size
+                    self.session.add_all(new_pages[start:end])
+                    self.session.flush()  # 批量插入,获取页面id
+                ids.update({page.unique_id: page.id for page in new_pages})
+                for start in range(0, len(updates), batch_size):
+                    end = start + batch_size
+                    self.session.execute(update(NavPage), updates[start:end])
+        self.delete_unused_page_schemas()
+        self.rebuild_pages_path()
+        return len(pages)
+
+    def delete_unused_page_schemas(self) -> int:
+        """删除没有页面引用的页面配置,返回删除的数量.未启用页面配置存储,或者关闭了自动删除时不处理"""
+        if not (self.schema_store and self.schema_store.auto_delete):
+            return 0
+        with trace_phase("delete_unused_page_schemas") as phase:
+            count = phase["rows"] = self.schema_store.delete_unused(self.session)
+        return count
+
+    def rebuild_pages_path(self) -> int:
+        """根据父级关系重建所有页面的路径索引,返回更新的页面数量"""
+        with trace_phase("rebuild_pages_path") as phase:
+            stmt = select(NavPage.id, NavPage.parent_id, NavPage.unique_id, NavPage.path, NavPage.depth)
+            rows = self.session.execute(stmt).all()
+            items = [{"id": row.id, "parent_id": row.parent_id, "unique_id": row.unique_id} for row in rows]
+            check_tree(items, max_depth=self.max_depth)  # 形成环的页面会被当作顶级页面,必须先检查
+            paths = calc_pages_path(items)
+            changed = [
+                {"id": row.id, "path": path, "depth": depth}
+                for row in rows
+                for path, depth in [paths[row.id]]
+                if (row.path, row.depth) != (path, depth)
+            ]
+            if changed:
+                self.session.execute(update(NavPage), changed)
+            phase["rows"] = len(changed)
+        return len(changed)
+
+    # 获取数据库中激活并且可见的页面
+    def get_db_active_pages(self, parent_id: int = None, is_permitted: Callable[[NavPage], bool] = None) -> List[dict]:
+        """获取数据库中的导舤链接
+        is_permitted: 判断页面是否有权限,如果指定,则只返回有权限的页面,并且删除没有子页面的分组
+        """
+        with trace_phase("load_active_pages") as phase:
+            pages = self.session.scalars(ACTIVE_PAGES_STMT).all()
+            phase["rows"] = len(pages)
+        return build_nav_links(pages, is_permitted)
+
+
+class AsyncAmisPageManager:
+    """基于AsyncSession的页面管理器.
+    查询直接在事件循环中执行,内存中的树处理复用AmisPageManager,不占用线程池;
+    需要逐条写入的同步操作通过AsyncSession.run_sync在协程中执行.
+    """
+
+    def __init__(self, session: AsyncSession, schema_store: PageSchemaStore = None, max_depth: int = DEFAULT_MAX_DEPTH):
+        self.session = session
+        self.schema_store = schema_store
+        self.max_depth = max_depth
+
+    def _manager(self, session: Session) -> AmisPageManager:
+        return AmisPageManager(session, self.schema_store, self.max_depth)
+
+    async def get_manager(self) -> AmisPageManager:
+        """获取已经加载全部页面的AmisPageManager,后续操作只读写内存中的ORM对象"""
+        manager = self._manager(self.session.sync_session)
+        with trace_phase("load_pages") as phase:
+            manager.db_pages = (await self.session.scalars(select(NavPage))).all()
+            phase["rows"] = len(manager.db_pages)
+        await self.session.run_sync(lambda _: manager.db_page_schemas)  # 在协程中读取页面配置存储
+        return manager
+
+    async def sync_site(self, admin_group: AdminGroup, fingerprint: str = None) -> bool:
+        return await self.session.run_sync(lambda session: self._manager(session).sync_site(admin_group, fingerprint))
+
+    async def reset_site_fingerprint(self):
+        await self.session.execute(RESET_SITE_FINGERPRINT_STMT)
+
+    async def site_to_db(self, admin_group: AdminGroup):
+        await self.session.run_sync(lambda session: self._manager(session).site_to_db(admin_group))
+        return self
+
+    async def db_to_site(self, admin_group: AdminGroup):
+        manager = await self.get_manager()
+        manager.db_to_site(admin_group)
+        return self
+
+    async def plan_db_to_site(self, admin_group: AdminGroup) -> SiteMenuPlan:
+        manager = await self.get_manager()
+        return manager.plan_db_to_site(admin_group)
+
+    async def update_db_pages_parent_and_sort(self, links: List[dict], parent_id: int = None) -> int:
+        with trace_phase("load_rows") as phase:
+            rows = (await self.session.execute(select(*PAGE_SORT_COLUMNS))).all()
+            phase["rows"] = len(rows)
+        with trace_phase("calc_pages_parent_and_sort") as phase:
+            changed = calc_pages_parent_and_sort(rows, links, parent_id, self.max_depth)
+            phase["rows"] = len(changed)
+        if changed:
+            with trace_phase("update_pages"):
+                await self.session.execute(update(NavPage), changed)
+        return len(changed)
+
+    async def delete_unused_page_schemas(self) -> int:
+        return await self.session.run_sync(lambda session: self._manager(session).delete_unused_page_schemas())
+
+    async def rebuild_pages_path(self) -> int:
+        return await self.session.run_sync(lambda session: self._manager(session).rebuild_pages_path())
+
+    async def get_pages_chunk(self, after: Tuple[int, int] = (-1, 0), limit: int = 1000) -> List[NavPage]:
+        return (await self.session.scalars(pages_chunk_stmt(after, limit))).all()
+
+    async def load_page_schemas(self, pages: List[NavPage]) -> Dict[str, str]:
+        return await self.session.run_sync(lambda session: self._manager(session).load_page_schemas(pages))
+
+    async def import_pages(self, pages: List[dict], batch_size: int = 1000) -> int:
+        return await self.session.run_sync(lambda session: self._manager(session).import_pages(pages, batch_size))
+
+    async def get_db_active_pages(self, parent_id: int = None, is_permitted: Callable[[NavPage], bool] = None) -> List[dict]:
+        with trace_phase("load_active_pages") as phase:
+            pages = (await self.session.scalars(ACTIVE_PAGES_STMT)).all()
+            phase["rows"] = len(pages)
+        return build_nav_links(pages, is_permitted)
+
+
+def build_nav_links(pages: List[NavPage], is_permitted: Callable[[NavPage], bool] = None) -> List[dict]:
+    """构建导航链接树.如果指定is_permitted,则过滤没有权限的页面;分组只要存在有权限的子页面就显示"""
+    with trace_phase("build_nav_links") as phase:
+        links = include_children([page.as_nav_link().amis_dict() for page in pages], key="value")
+        if is_permitted is not None:
+            permitted = {page.id for page in pages if not page.is_group and is_permitted(page)}
+            links = prune_tree(links, lambda link: link["value"] in permitted)
+        phase["rows"] = len(pages)
+    return links
+
+
+def calc_pages_parent_and_sort(
+    rows: List[Row], links: List[dict], parent_id: int = None, max_depth: int = DEFAULT_MAX_DEPTH
+) -> List[dict]:
+    """根据amis的导航菜单数据计算页面的排序和父级关系,返回发生变化的页面
+    rows: 数据库中页面的PAGE_SORT_COLUMNS字段
+    """
+    current = {row.id: row for row in rows}
+    site_page_id = next((row.id for row in rows if row.parent_id is None), None)
+    target = {row.id: {"id": row.id, "parent_id": row.parent_id, "sort": row.sort} for row in rows}
+    stack: List[Tuple[List[dict], Optional[int], int]] = [(links, parent_id, 0)]
+    seen: Set[int] = set()
+    while stack:
+        links_, parent_id_, depth = stack.pop()
+        if depth >= max_depth:
+            raise NavTreeError.max_depth(links_[0].get("value"), max_depth)
+        for i, link in enumerate(links_):
+            row = current.get(link["value"])
+            if not row:
                 continue
-            page.sort = -1 * i  # 排序
-            if page.id != self.site_page.id:  # 如果不是根级,则更新父级.
-                page.parent_id = parent_id or self.site_page.id  # 父级
+            if row.id in seen:  # 同一页面出现多次
+                raise NavTreeError.duplicate(row.id)
+            seen.add(row.id)
+            page = target[row.id]
+            if row.id != site_page_id:  # 如果不是根级,则更新父级.
+                page["parent_id"] = parent_id_ or site_page_id
+            page["sort"] = -1 * i  # 排序
             if link.get("children"):
-                self.update_db_pages_parent_and_sort(
-                    link["children"], parent_id=page.id if page.is_group else page.parent_id
-                )
+                stack.append((link["children"], row.id if row.is_group else page["parent_id"], depth + 1))
+    # 只调整了部分页面时,新的父级关系仍可能形成环
+    check_tree(list(target.values()), max_depth=max_depth)
+    # 父级变化后,同步更新所有下级页面的路径索引
+    for id_, (path, depth) in calc_pages_path(target.values()).items():
+        target[id_].update(path=path, depth=depth)
+    return [page for page in target.values() if any(getattr(current[page["id"]], key) != value for key, value in page.items())]
 
-    # 获取数据库中激活并且可见的页面
-    def get_db_active_pages(self, parent_id: int = None) -> List[dict]:
-        """获取数据库中的导舤链接"""
-        stmt = select(NavPage).where(NavPage.is_active == True, NavPage.visible == True).order_by(NavPage.sort.desc())
-        pages = self.session.scalars(stmt)
-        return include_children([page.as_nav_link().amis_dict() for page in pages], key="value")
+
+class TreeResult(NamedTuple):
+    """树构建结果"""
+
+    roots: List[dict]  # 根节点
+    orphans: List[dict]  # 父节点不存在的节点
+    cycles: List[dict]  # 父子关系形成环的节点(已从环中断开)
+
+
+def build_tree(
+    items: List[dict],
+    key: str = "id",
+    parent_key: str = "parent_id",
+    children_key: str = "children",
+) -> TreeResult:
+    """单次遍历构建树, 时间复杂度O(n), 保持兄弟节点的原始顺序.
+    父节点不存在的节点放入orphans, 形成环的节点在环中断开后放入cycles.
+    """
+    index: Dict[Any, dict] = {}
+    for item in items:
+        index.setdefault(item[key], item)
+    roots: List[dict] = []
+    orphans: List[dict] = []
+    attached: Dict[int, dict] = {}  # id(节点) -> 父节点
+    for item in items:
+        parent_value = item.get(parent_key, None)
+        if parent_value is None:
+            roots.append(item)
+            continue
+        parent = index.get(parent_value)
+        if parent is None or parent is item:
+            orphans.append(item)
+            continue
+        if not parent.get(children_key):
+            parent[children_key] = []
+        parent[children_key].append(item)
+        attached[id(item)] = parent
+    # 从根节点和孤立节点出发, 标记所有可达节点; 其余节点必然处于环中或挂在环上
+    reached = set()
+    for node in iter_tree([*roots, *orphans], children_key=children_key):
+        reached.add(id(node[1]))
+    cycles: List[dict] = []
+    for item in items:
+        if id(item) in reached:
+            continue
+        # 沿父级向上查找, 找到第一个重复的节点, 将其从父节点中断开
+        seen = set()
+        node = item
+        while id(node) not in seen:
+            seen.add(id(node))
+            node = attached[id(node)]
+        parent = attached.pop(id(node))
+        parent[children_key] = [child for child in parent[children_key] if child is not node]
+        cycles.append(node)
+        for _, child in iter_tree([node], children_key=children_key):
+            reached.add(id(child))
+    return TreeResult(roots, orphans, cycles)
+
+
+def check_tree(
+    items: List[dict], key: str = "id", parent_key: str = "parent_id", max_depth: int = DEFAULT_MAX_DEPTH
+) -> List[List[dict]]:
+    """检查父子关系,父子关系形成环或者层级超过max_depth时抛出NavTreeError.
+    返回按层级分组的节点(items的浅复制),父节点不存在的节点作为顶级节点.
+    """
+    nodes = [{**item, "children": []} for item in items]
+    roots, orphans, cycles = build_tree(nodes, key=key, parent_key=parent_key)
+    if cycles:
+        raise NavTreeError.cycle(cycles[0].get("unique_id", cycles[0][key]))
+    levels: List[List[dict]] = []
+    depths: List[int] = []
+    for parent_index, node in iter_tree([*roots, *orphans]):
+        depth = depths[parent_index] + 1 if parent_index >= 0 else 0
+        if depth >= max_depth:
+            raise NavTreeError.max_depth(node.get("unique_id", node[key]), max_depth)
+        depths.append(depth)
+        if depth == len(levels):
+            levels.append([])
+        levels[depth].append(node)
+    return levels
+
+
+def iter_tree(nodes: List[dict], children_key: str = "children") -> Iterator[Tuple[int, dict]]:
+    """非递归先序遍历树, 生成(父节点序号, 节点). 父节点序号为该节点父级在遍历序列中的位置, 根节点为-1"""
+    stack: List[Tuple[int, dict]] = [(-1, node) for node in reversed(nodes)]
+    index = 0
+    while stack:
+        parent_index, node = stack.pop()
+        yield parent_index, node
+        children = node.get(children_key)
+        if children:
+            stack.extend((index, child) for child in reversed(children))
+        index += 1
+
+
+def prune_tree(nodes: List[dict], keep: Callable[[dict], bool], children_key: str = "children") -> List[dict]:
+    """非递归地裁剪树: 保留满足keep的节点,以及存在保留子节点的节点.不修改原节点"""
+    visited = list(iter_tree(nodes, children_key=children_key))
+    kept_children: Dict[int, List[dict]] = {}  # 父节点遍历序号 -> 保留的子节点
+    for index in range(len(visited) - 1, -1, -1):  # 倒序遍历,先处理子节点
+        parent_index, node = visited[index]
+        children = kept_children.pop(index, [])
+        if children or keep(node):
+            children.reverse()  # 倒序收集,恢复原始顺序
+            node = {**node, children_key: children} if children_key in node else node
+            kept_children.setdefault(parent_index, []).append(node)
+    roots = kept_children.get(-1, [])
+    roots.reverse()
+    return roots
+
+
+def check_page_path(path: str, page: Any) -> str:
+    """检查页面路径索引是否超出列宽,超出时抛出NavTreeError"""
+    if len(path) > PATH_MAX_LENGTH:
+        raise NavTreeError.path_length(page)
+    return path
+
+
+def calc_pages_path(pages: Iterable[dict]) -> Dict[int, Tuple[str, int]]:
+    """根据父级关系计算页面的路径索引和层级, 返回 id -> (path, depth)"""
+    items = [{"id": page["id"], "parent_id": page["parent_id"]} for page in pages]
+    paths: Dict[int, Tuple[str, int]] = {}
+    nodes: List[dict] = []
+    for parent_index, node in iter_tree(include_children(items)):
+        if parent_index < 0:
+            paths[node["id"]] = ("/", 0)
+        else:
+            parent = nodes[parent_index]
+            parent_path, parent_depth = paths[parent["id"]]
+            paths[node["id"]] = (check_page_path(f"{parent_path}{parent['id']}/", node["id"]), parent_depth + 1)
+        nodes.append(node)
+    return paths
+
+
+def upgrade_db_tables(connection: Connection) -> List[str]:
+    """为旧版本创建的页面表添加新增的列和索引,返回添加的列名.
+    新增的列: page_schema_hash, path, depth;添加后需要重建页面的路径索引.
+    """
+    table = NavPage.__table__
+    inspector = inspect(connection)
+    if not inspector.has_table(table.name):
+        return []
+    columns = {column["name"] for column in inspector.get_columns(table.name)}
+    preparer = connection.dialect.identifier_preparer
+    added = []
+    for name in ("page_schema_hash", "path", "depth"):
+        if name in columns:
+            continue
+        column = table.columns[name]
+        sql = f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} "
+        sql += column.type.compile(dialect=connection.dialect)
+        if not column.nullable:  # 非空列使用默认值填充已有的行
+            default = literal(column.default.arg).compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+            sql += f" DEFAULT {default} NOT NULL"
+        connection.execute(text(sql))
+        added.append(name)
+    indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in indexes:
+            index.create(connection)
+    return added
+
+
+def parse_import_page(line: Union[str, bytes]) -> dict:
+    """解析导入数据的一行,数据格式错误时抛出ValueError"""
+    page = json.loads(line)
+    if not isinstance(page, dict) or not page.get("unique_id") or not isinstance(page["unique_id"], str):
+        raise ValueError("页面缺少unique_id")
+    parent_unique_id = page.get("parent_unique_id")
+    if parent_unique_id is not None and not isinstance(parent_unique_id, str):
+        raise ValueError("parent_unique_id必须是字符串")
+    return page
+
+
+def site_fingerprint(admin_group: AdminGroup) -> str:
+    """计算site菜单的指纹,site注册的页面及其配置不变,则指纹不变"""
+    md5 = hashlib.md5(__version__.encode())  # 版本升级后,重新同步一次
+    md5.update(f"{admin_group.unique_id}:{admin_group.page_schema and admin_group.page_schema.amis_json()}".encode())
+    for unique_id, (admin, parent) in index_admin_group(admin_group).items():
+        page_schema = admin.page_schema and admin.page_schema.amis_json()
+        is_group = isinstance(admin, AdminGroup)
+        md5.update(f"\n{unique_id}:{parent.unique_id}:{is_group}:{page_schema}".encode())
+    return md5.hexdigest()
+
+
+def index_admin_group(admin_group: AdminGroup) -> Dict[str, Tuple[PageSchemaAdmin, AdminGroup]]:
+    """遍历一次AdminGroup,建立unique_id到(admin, 父级)的索引.同一unique_id以先序遍历中第一次出现的为准"""
+    index: Dict[str, Tuple[PageSchemaAdmin, AdminGroup]] = {}
+    stack: List[Tuple[PageSchemaAdmin, AdminGroup]] = [(child, admin_group) for child in reversed(list(admin_group))]
+    while stack:
+        admin, parent = stack.pop()
+        index.setdefault(admin.unique_id, (admin, parent))
+        if isinstance(admin, AdminGroup):
+            stack.extend((child, admin) for child in reversed(list(admin)))
+    return index
 
 
 def include_children(items: List[dict], key: str = "id", parent_key: str = "parent_id") -> List[dict]:
-    """处理父子节点关系, 递归.NodeT必须有id,parent_id,children属性"""
-
-    result: List[dict] = []
-
-    def append_child(parent: dict, child_: dict):
-        if not parent.get("children"):
-            parent["children"] = []
-        parent["children"].append(child_)
-        return parent
-
-    def insert_new_node(node: dict, new_items: List[dict], is_top: bool = False) -> bool:
-        #  先把列表中的子节点全部找出来.
-        for item in new_items.copy():
-            if node[key] == item.get(parent_key, None):  # 找出新节点的子节点,添加到新节点的children中
-                new_items.remove(item)
-                node = append_child(node, item)
-        for i, item in enumerate(new_items):
-            if node.get(parent_key, None) == item[key]:  # 如果新节点的父级是当前节点,则添加到当前节点的子节点中
-                new_items[i] = append_child(item, node)
-                return True
-            if item.get("children"):
-                if insert_new_node(node, item["children"], is_top=False):
-                    return True
-        if is_top:
-            new_items.append(node)
-        return False
-
-    for child in items:
-        insert_new_node(child, result, is_top=True)
-
-    return result
+    """处理父子节点关系.NodeT必须有id,parent_id,children属性.
+    父节点不存在的节点, 以及从环中断开的节点, 都作为顶级节点返回.
+    """
+    roots, orphans, cycles = build_tree(items, key=key, parent_key=parent_key)
+    return [*roots, *orphans, *cycles]
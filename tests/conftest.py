@@ -0,0 +1,100 @@
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Type
+
+import pytest
+from fastapi import FastAPI
+from fastapi_amis_admin import admin
+from fastapi_amis_admin.admin.settings import Settings
+from fastapi_amis_admin.admin.site import AdminSite
+from fastapi_amis_admin.amis import PageSchema
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import event, select
+from sqlalchemy.engine import Row
+from sqlmodel import SQLModel
+
+from fastapi_amis_admin_nav.admin import NavPageAdmin
+from fastapi_amis_admin_nav.models import NavPage
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE")
+
+
+class NavAdmin(NavPageAdmin):
+    invalidation_poll_interval = 0  # 测试中不启动轮询任务
+
+
+def make_page_admins(count: int, prefix: str = "Page") -> List[Type[admin.PageAdmin]]:
+    """创建count个页面管理类"""
+    return [type(f"{prefix}{i}", (admin.PageAdmin,), {"page_schema": PageSchema(label=f"{prefix}{i}")}) for i in range(count)]
+
+
+def make_group_admin(name: str, admins: List[type]) -> Type[admin.AdminApp]:
+    """创建包含admins的分组管理类"""
+
+    def __init__(self, app):
+        admin.AdminApp.__init__(self, app)
+        self.register_admin(*admins)
+
+    return type(name, (admin.AdminApp,), {"page_schema": PageSchema(label=name, icon="fa fa-folder"), "__init__": __init__})
+
+
+class StatementCounter:
+    """统计数据库执行的SQL语句"""
+
+    def __init__(self, site: AdminSite):
+        self.engine = site.db.engine.sync_engine
+        self.statements: List[str] = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self) -> "StatementCounter":
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+    @property
+    def writes(self) -> List[str]:
+        return [statement for statement in self.statements if statement.split(None, 1)[0].upper() in WRITE_STATEMENTS]
+
+
+@pytest.fixture
+async def make_site(tmp_path: Path) -> AsyncIterator[Callable[..., AdminSite]]:
+    """创建使用临时sqlite数据库的site.相同的db_name共享同一个数据库文件,模拟重启或者多进程.
+    sqlalchemy_database按URL复用数据库实例,每个site使用不同的URL指向同一个文件,各自拥有独立的引擎和session.
+    """
+    sites: List[AdminSite] = []
+    processes: Dict[str, int] = {}
+
+    def factory(*admins: type, db_name: str = "nav.db", nav_admin: Type[NavPageAdmin] = NavAdmin) -> AdminSite:
+        process = processes[db_name] = processes.get(db_name, -1) + 1
+        site = AdminSite(settings=Settings(database_url_async=f"sqlite+aiosqlite:///{tmp_path}/{'./' * process}{db_name}"))
+        assert all(site.db is not other.db for other in sites)
+        site.register_admin(*admins, nav_admin)
+        site.mount_app(FastAPI())
+        sites.append(site)
+        return site
+
+    yield factory
+    for site in sites:
+        await site.fastapi.router.shutdown()
+        await site.db.engine.dispose()
+
+
+async def startup(site: AdminSite) -> AdminSite:
+    """创建数据表,并且运行site的启动事件"""
+    await site.db.async_run_sync(SQLModel.metadata.create_all, is_session=False)
+    await site.fastapi.router.startup()
+    return site
+
+
+async def load_pages(site: AdminSite) -> List[Row]:
+    """查询数据库中的所有页面"""
+    columns = [column for name, column in NavPage.__table__.columns.items() if name != "page_schema"]
+    async with site.db():
+        return (await site.db.async_execute(select(*columns).order_by(NavPage.id))).all()
+
+
+def client(site: AdminSite) -> AsyncClient:
+    return AsyncClient(transport=ASGITransport(app=site.application), base_url="http://testserver")
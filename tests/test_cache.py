@@ -0,0 +1,23 @@
+from fastapi_amis_admin_nav.cache import NavCache, etag_matches, make_etag
+
+
+def test_etag_matches():
+    etag = make_etag(b"content")
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches(None, etag)
+    assert not etag_matches('"other"', etag)
+    # 只去除一次W/前缀
+    assert not etag_matches(f"W/W/{etag}", etag)
+    assert not etag_matches(f"/{etag}", etag)
+
+
+def test_nav_cache_skips_stale_set():
+    cache = NavCache()
+    version = cache.version
+    cache.invalidate()  # 读取期间缓存失效
+    cache.set("key", "stale", version)
+    assert cache.get("key") is None
+    cache.set("key", "fresh", cache.version)
+    assert cache.get("key") == "fresh"
@@ -0,0 +1,67 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import ORMExecuteState, Session, raiseload
+
+from fastapi_amis_admin_nav.models import NavPage
+from fastapi_amis_admin_nav.utils import AmisPageManager
+from tests.conftest import (
+    StatementCounter,
+    load_pages,
+    make_group_admin,
+    make_page_admins,
+    startup,
+)
+
+
+@pytest.fixture
+def raise_on_parent_load():
+    """查询页面时禁止加载parent关系,访问page.parent时抛出异常"""
+
+    def add_raiseload(state: ORMExecuteState):
+        if state.is_select and any(item["expr"] is NavPage for item in state.statement.column_descriptions):
+            state.statement = state.statement.options(raiseload(NavPage.parent))
+
+    event.listen(Session, "do_orm_execute", add_raiseload)
+    yield
+    event.remove(Session, "do_orm_execute", add_raiseload)
+
+
+async def count_sync_statements(site) -> int:
+    """在新的session中执行一次site_to_db和db_to_site,返回执行的SQL语句数量"""
+    with StatementCounter(site) as counter:
+        async with site.db():
+            await site.db.async_run_sync(lambda session: AmisPageManager(session).site_to_db(site).db_to_site(site))
+    return len(counter.statements)
+
+
+async def test_sync_statements_independent_of_tree_size(make_site):
+    small = await startup(make_site(make_group_admin("Small", make_page_admins(3, "Small")), db_name="small.db"))
+    large = await startup(make_site(make_group_admin("Large", make_page_admins(30, "Large")), db_name="large.db"))
+    # 页面全部加载后,逐个访问parent关系也只会从identity map中读取,N+1由test_db_to_site_without_parent_relationship检查
+    assert await count_sync_statements(large) == await count_sync_statements(small)
+
+
+async def test_db_to_site_restores_tree(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(3))))
+    async with site.db():
+        await site.db.async_run_sync(lambda session: AmisPageManager(session).db_to_site(site))
+    group = next(admin for admin in site._children if admin.__class__.__name__ == "Group")
+    assert sorted(admin.__class__.__name__ for admin in group._children) == ["Page0", "Page1", "Page2"]
+
+
+async def test_db_to_site_without_parent_relationship(make_site, raise_on_parent_load):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(2))))
+    group_page = next(page for page in await load_pages(site) if page.label == "Group")
+    # 自定义页面不存在于site中,需要沿上级页面逐级添加
+    async with site.db():
+        custom = NavPage(label="Custom", unique_id="custom", is_group=True, is_custom=True, parent_id=group_page.id)
+        site.db.add(custom)
+        await site.db.async_flush()
+        site.db.add(NavPage(label="Child", unique_id="child", is_custom=True, parent_id=custom.id))
+    # 上级页面从已经加载的页面中获取,不访问parent关系
+    async with site.db():
+        await site.db.async_run_sync(lambda session: AmisPageManager(session).db_to_site(site))
+    group = next(admin for admin in site._children if admin.__class__.__name__ == "Group")
+    assert sorted(admin.page_schema.label for admin in group._children) == ["Custom", "Page0", "Page1"]
+    custom = next(admin for admin in group._children if admin.page_schema.label == "Custom")
+    assert [admin.page_schema.label for admin in custom._children] == ["Child"]
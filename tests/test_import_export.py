@@ -0,0 +1,84 @@
+import json
+from typing import List
+
+from tests.conftest import (
+    NavAdmin,
+    client,
+    load_pages,
+    make_group_admin,
+    make_page_admins,
+    startup,
+)
+
+
+def tree_of(pages) -> dict:
+    """页面的unique_id -> (label, 上级页面的unique_id)"""
+    unique_ids = {page.id: page.unique_id for page in pages}
+    return {page.unique_id: (page.label, unique_ids.get(page.parent_id)) for page in pages}
+
+
+async def export_pages(site) -> List[dict]:
+    nav = site.get_admin_or_create(NavAdmin)
+    async with client(site) as c:
+        res = await c.get(f"{nav.router_path}/export_pages")
+    return [json.loads(line) for line in res.text.splitlines()]
+
+
+async def import_pages(site, content: str) -> dict:
+    nav = site.get_admin_or_create(NavAdmin)
+    async with client(site) as c:
+        res = await c.post(f"{nav.router_path}/import_pages", content=content)
+    return res.json()
+
+
+def dumps(pages: List[dict]) -> str:
+    return "\n".join(json.dumps(page) for page in pages)
+
+
+async def test_export_import_round_trip(make_site):
+    source = await startup(make_site(make_group_admin("Group", make_page_admins(3)), db_name="source.db"))
+    exported = await export_pages(source)
+    assert [page["unique_id"] for page in exported if page.get("site_root")] == [exported[0]["unique_id"]]
+    target = await startup(make_site(make_group_admin("Other", make_page_admins(1, "Other")), db_name="target.db"))
+    res = await import_pages(target, dumps(exported))
+    assert res["status"] == 0 and res["data"] == len(exported)
+    imported = tree_of(await load_pages(target))
+    assert all(imported[unique_id] == tree for unique_id, tree in tree_of(await load_pages(source)).items())
+    # 重复导入,页面保持不变
+    pages = await load_pages(target)
+    assert (await import_pages(target, dumps(exported)))["status"] == 0
+    assert tree_of(await load_pages(target)) == tree_of(pages)
+
+
+async def test_import_merges_only_exported_root(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(1))))
+    root = (await load_pages(site))[0]
+    # 导出的根页面与当前根页面的unique_id不同,合并到当前的根页面
+    pages = [
+        {"unique_id": "other_root", "label": "OtherRoot", "site_root": True},
+        {"unique_id": "child", "label": "Child", "parent_unique_id": "other_root"},
+    ]
+    assert (await import_pages(site, dumps(pages)))["status"] == 0
+    tree = tree_of(await load_pages(site))
+    assert "other_root" not in tree
+    assert tree[root.unique_id][0] == "OtherRoot" and tree["child"] == ("Child", root.unique_id)
+    # 多个顶级页面不合并,根页面保持不变
+    pages = [{"unique_id": "orphan1", "label": "Orphan1"}, {"unique_id": "orphan2", "label": "Orphan2", "site_root": True}]
+    assert (await import_pages(site, dumps(pages)))["status"] == 0
+    tree = tree_of(await load_pages(site))
+    assert tree[root.unique_id][0] == "OtherRoot"
+    assert tree["orphan1"] == ("Orphan1", None) and tree["orphan2"] == ("Orphan2", None)
+
+
+async def test_import_rejects_invalid_rows(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(1))))
+    pages = await load_pages(site)
+    valid = json.dumps({"unique_id": "valid", "label": "Valid"})
+    for line in ["{", "[1, 2]", '"page"', '{"label": "x"}', '{"unique_id": 1}', '{"unique_id": "x", "parent_unique_id": {}}']:
+        res = await import_pages(site, f"{valid}\n{line}")
+        assert res == {"status": -1, "msg": "第2行数据格式错误", "data": None, "code": None}
+    res = await import_pages(site, dumps([{"unique_id": "child", "label": "Child", "parent_unique_id": "missing"}]))
+    assert res["data"] == {"code": "missing_parent", "page": "child"}
+    res = await import_pages(site, dumps([{"unique_id": "twice", "label": "A"}, {"unique_id": "twice", "label": "B"}]))
+    assert res["data"] == {"code": "duplicate", "page": "twice"}
+    assert await load_pages(site) == pages
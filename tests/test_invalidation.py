@@ -0,0 +1,47 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from fastapi_amis_admin_nav.invalidation import (
+    BaseInvalidationChannel,
+    DBPollingChannel,
+)
+from fastapi_amis_admin_nav.models import NavPageMeta
+from tests.conftest import NavAdmin, make_group_admin, make_page_admins, startup
+
+
+def test_base_channel_is_abstract():
+    with pytest.raises(TypeError):
+        BaseInvalidationChannel()
+
+
+def test_publish_retries_when_created_concurrently():
+    engine = create_engine("sqlite://")
+    NavPageMeta.__table__.create(engine)
+
+    def create_meta(conn, cursor, statement, parameters, context, executemany):
+        # 模拟其他进程在UPDATE之后,INSERT之前创建了版本号
+        if statement.startswith("UPDATE system_page_meta"):
+            conn.connection.cursor().execute("INSERT INTO system_page_meta (key, value, version) VALUES ('version:pages', '', 1)")
+
+    event.listen(engine, "after_cursor_execute", create_meta, once=True)
+    with Session(engine) as session:
+        assert DBPollingChannel(None)._publish(session, "pages") == 2
+        assert DBPollingChannel(None)._publish(session, "pages") == 3
+
+
+async def test_pages_versions_recorded_after_commit(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(1))))
+    nav = site.get_admin_or_create(NavAdmin)
+    versions = dict(nav._pages_versions)
+    async with site.db():
+        await nav.on_pages_changed(reload_site=True)
+        assert nav._pages_versions == versions  # 事务未提交,不记录版本号
+        await site.db.async_rollback()
+    assert nav._pages_versions == versions
+    async with site.db():
+        await nav.on_pages_changed(reload_site=True)
+        await site.db.async_run_sync(lambda session: session.begin_nested().commit())
+        assert nav._pages_versions == versions  # 保存点提交,不记录版本号
+    assert nav._pages_versions == await nav.invalidation_channel.get_versions(["pages", "site"])
+    assert nav._pages_versions != versions
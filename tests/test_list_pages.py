@@ -0,0 +1,64 @@
+from sqlalchemy import update
+from starlette.requests import Request
+
+from fastapi_amis_admin_nav.models import NavPage
+from tests.conftest import (
+    NavAdmin,
+    client,
+    load_pages,
+    make_group_admin,
+    make_page_admins,
+    startup,
+)
+
+
+class LazyNavAdmin(NavAdmin):
+    list_lazy_children = True
+    list_per_page = 2
+
+
+async def lazy_site(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(4)), nav_admin=LazyNavAdmin))
+    async with site.db():
+        await site.db.async_execute(update(NavPage).where(NavPage.label == "Page3").values(is_active=False))
+    return site, site.get_admin_or_create(LazyNavAdmin)
+
+
+async def test_list_default_filters_pages_roots(make_site):
+    site, nav = await lazy_site(make_site)
+    async with client(site) as c:
+        res = await c.post(f"{nav.router_path}/list", json=nav.list_default_filters)
+    assert [(item["label"], item.get("defer")) for item in res.json()["data"]["items"]] == [("AdminSite", True)]
+
+
+async def test_list_other_filters_fall_back_to_flat_list(make_site):
+    site, nav = await lazy_site(make_site)
+    async with client(site) as c:
+        res = await c.post(f"{nav.router_path}/list", json={"is_active": False})
+    # 未激活的页面的上级页面是激活的,只能通过普通列表查看
+    assert [(item["label"], item.get("defer")) for item in res.json()["data"]["items"]] == [("Page3", None)]
+
+
+async def test_get_children_pages_with_default_filters(make_site):
+    site, nav = await lazy_site(make_site)
+    group_id = next(page.id for page in await load_pages(site) if page.label == "Group")
+    async with client(site) as c:
+        first = (await c.get(f"{nav.router_path}/get_children", params={"parent_id": group_id})).json()["data"]
+        more = first["children"][-1]
+        second = (await c.get(more["deferApi"].split(":", 1)[1])).json()["data"]
+    assert first["hasMore"] is True and more["load_more"] is True
+    labels = [child["label"] for child in first["children"][:-1] + second["children"]]
+    assert sorted(labels) == ["Page0", "Page1", "Page2"] and second["hasMore"] is False
+
+
+async def test_load_more_row_hides_item_actions(make_site):
+    site, nav = await lazy_site(make_site)
+    request = Request({"type": "http", "headers": [], "query_string": b""})
+    for flag in ("item", "column"):
+        assert all(action.visibleOn.startswith("!this.load_more") for action in await nav.get_actions(request, flag))
+
+
+async def test_get_children_registered_only_for_lazy_children(make_site):
+    site = make_site(make_group_admin("Group", make_page_admins(1)))
+    nav = site.get_admin_or_create(NavAdmin)
+    assert not any(route.path.endswith("/get_children") for route in nav.router.routes)
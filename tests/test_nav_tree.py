@@ -0,0 +1,112 @@
+import json
+import pickle
+from collections import namedtuple
+
+import pytest
+from sqlalchemy import update
+
+from fastapi_amis_admin_nav.models import NavPage
+from fastapi_amis_admin_nav.utils import (
+    AmisPageManager,
+    NavTreeError,
+    calc_pages_parent_and_sort,
+    check_tree,
+)
+from tests.conftest import (
+    NavAdmin,
+    client,
+    load_pages,
+    make_group_admin,
+    make_page_admins,
+    startup,
+)
+
+PageRow = namedtuple("PageRow", ["id", "parent_id", "sort", "is_group", "path", "depth"])
+
+
+def chain(count: int) -> list:
+    """count层的页面链"""
+    return [{"id": i + 1, "parent_id": i or None} for i in range(count)]
+
+
+def test_check_tree_levels():
+    levels = check_tree([{"id": 1, "parent_id": None}, {"id": 2, "parent_id": 1}, {"id": 3, "parent_id": 1}])
+    assert [[node["id"] for node in level] for level in levels] == [[1], [2, 3]]
+
+
+def test_check_tree_errors():
+    with pytest.raises(NavTreeError) as info:
+        check_tree([{"id": 1, "parent_id": None}, {"id": 2, "parent_id": 3}, {"id": 3, "parent_id": 2}])
+    assert info.value.code == "cycle"
+    check_tree(chain(5), max_depth=5)
+    with pytest.raises(NavTreeError) as info:
+        check_tree(chain(6), max_depth=5)
+    assert info.value.dict() == {"code": "max_depth", "page": 6}
+
+
+def test_calc_pages_parent_and_sort_errors():
+    rows = [PageRow(1, None, 0, True, "/", 0), PageRow(2, 1, 0, True, "/1/", 1), PageRow(3, 2, 0, False, "/1/2/", 2)]
+    with pytest.raises(NavTreeError) as info:
+        calc_pages_parent_and_sort(rows, [{"value": 2, "children": [{"value": 3}, {"value": 3}]}])
+    assert info.value.code == "duplicate"
+    with pytest.raises(NavTreeError) as info:
+        calc_pages_parent_and_sort(rows, [{"value": 2, "children": [{"value": 3}]}], max_depth=1)
+    assert info.value.code == "max_depth"
+
+
+def test_nav_tree_error_pickle():
+    error = pickle.loads(pickle.dumps(NavTreeError.cycle("page")))
+    assert (error.code, error.page, str(error)) == ("cycle", "page", "页面的上级菜单形成了循环: page")
+
+
+async def test_update_pages_rejects_duplicate(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(2))))
+    nav = site.get_admin_or_create(NavAdmin)
+    pages = await load_pages(site)
+    page = next(page for page in pages if page.label == "Page0")
+    async with client(site) as c:
+        links = [{"value": page.parent_id, "children": [{"value": page.id}, {"value": page.id}]}]
+        res = await c.post(f"{nav.router_path}/update_pages", json={"data": links})
+    assert res.json()["data"] == {"code": "duplicate", "page": page.id}
+    assert await load_pages(site) == pages
+
+
+async def test_import_rejects_cycle_and_max_depth(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(1))))
+    nav = site.get_admin_or_create(NavAdmin)
+    cycle = [
+        {"unique_id": "a", "label": "A", "parent_unique_id": "b"},
+        {"unique_id": "b", "label": "B", "parent_unique_id": "a"},
+    ]
+    deep = [{"unique_id": f"d{i}", "label": f"D{i}", "parent_unique_id": f"d{i - 1}" if i else None} for i in range(40)]
+    async with client(site) as c:
+        res = await c.post(f"{nav.router_path}/import_pages", content="\n".join(map(json.dumps, cycle)))
+        assert res.json()["data"]["code"] == "cycle"
+        res = await c.post(f"{nav.router_path}/import_pages", content="\n".join(map(json.dumps, deep)))
+        assert res.json()["data"] == {"code": "max_depth", "page": f"d{nav.page_max_depth}"}
+
+
+async def test_startup_keeps_site_menu_on_max_depth(make_site):
+    class ShallowNavAdmin(NavAdmin):
+        page_max_depth = 2
+
+    group = make_group_admin("Outer", [make_group_admin("Inner", make_page_admins(1))])
+    site = await startup(make_site(group, nav_admin=ShallowNavAdmin))  # 菜单层级超过最大深度,不影响启动
+    assert await load_pages(site) == []
+    assert [admin.__class__.__name__ for admin in site.get_admin_or_create(group)._children] == ["Inner"]
+
+
+async def test_rebuild_pages_path_rejects_cycle(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(2))))
+    page0, page1 = [page for page in await load_pages(site) if page.label in ("Page0", "Page1")]
+    async with site.db():
+        await site.db.async_execute(update(NavPage).where(NavPage.id == page0.id).values(parent_id=page1.id))
+        await site.db.async_execute(update(NavPage).where(NavPage.id == page1.id).values(parent_id=page0.id))
+    pages = await load_pages(site)
+    # 形成环的页面不能作为顶级页面写入根路径
+    async with site.db():
+        with pytest.raises(NavTreeError) as info:
+            await site.db.async_run_sync(lambda session: AmisPageManager(session).rebuild_pages_path())
+        await site.db.async_rollback()
+    assert info.value.code == "cycle"
+    assert await load_pages(site) == pages
@@ -0,0 +1,65 @@
+import json
+from typing import Set
+
+from fastapi_amis_admin.admin.site import AdminSite
+from sqlalchemy import select
+
+from fastapi_amis_admin_nav.models import NavPage, NavPageSchema
+from fastapi_amis_admin_nav.schema_store import PageSchemaStore
+from tests.conftest import (
+    NavAdmin,
+    client,
+    load_pages,
+    make_group_admin,
+    make_page_admins,
+    startup,
+)
+
+
+class StoreNavAdmin(NavAdmin):
+    page_schema_store = PageSchemaStore(compress_min_size=0)
+
+
+async def load_hashes(site: AdminSite) -> Set[str]:
+    """页面配置存储中保存的哈希"""
+    async with site.db():
+        return set((await site.db.async_scalars(select(NavPageSchema.hash))).all())
+
+
+async def load_used_hashes(site: AdminSite) -> Set[str]:
+    """页面引用的配置哈希"""
+    async with site.db():
+        return set(
+            (await site.db.async_scalars(select(NavPage.page_schema_hash).where(NavPage.page_schema_hash.is_not(None)))).all()
+        )
+
+
+async def test_delete_unused_after_write(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(2)), nav_admin=StoreNavAdmin))
+    nav = site.get_admin_or_create(StoreNavAdmin)
+    assert await load_hashes(site) == await load_used_hashes(site)
+    pages = {page.label: page for page in await load_pages(site)}
+    async with client(site) as c:
+        res = await c.put(f"{nav.router_path}/item/{pages['Page0'].id}", json={"page_schema": '{"label": "Edited"}'})
+        assert res.json()["status"] == 0
+        assert (await c.delete(f"{nav.router_path}/item/{pages['Page1'].id}")).json()["status"] == 0
+        content = json.dumps({"unique_id": "imported", "label": "Imported", "page_schema": '{"label": "Imported"}'})
+        assert (await c.post(f"{nav.router_path}/import_pages", content=content)).json()["status"] == 0
+        content = json.dumps({"unique_id": "imported", "label": "Imported", "page_schema": '{"label": "Reimported"}'})
+        assert (await c.post(f"{nav.router_path}/import_pages", content=content)).json()["status"] == 0
+    # 修改,删除和重新导入后,不再被引用的配置已经删除
+    assert pages["Page0"].page_schema_hash not in await load_hashes(site)
+    assert pages["Page1"].page_schema_hash not in await load_hashes(site)
+    assert await load_hashes(site) == await load_used_hashes(site)
+
+
+async def test_keep_unused_without_auto_delete(make_site):
+    class KeepNavAdmin(NavAdmin):
+        page_schema_store = PageSchemaStore(auto_delete=False)
+
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(2)), nav_admin=KeepNavAdmin))
+    nav = site.get_admin_or_create(KeepNavAdmin)
+    page = next(page for page in await load_pages(site) if page.label == "Page0")
+    async with client(site) as c:
+        assert (await c.delete(f"{nav.router_path}/item/{page.id}")).json()["status"] == 0
+    assert page.page_schema_hash in await load_hashes(site)
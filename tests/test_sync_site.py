@@ -0,0 +1,55 @@
+from tests.conftest import (
+    NavAdmin,
+    StatementCounter,
+    client,
+    load_pages,
+    make_group_admin,
+    make_page_admins,
+    startup,
+)
+
+
+async def test_restart_skips_unchanged_site(make_site):
+    group = make_group_admin("Group", make_page_admins(3))
+    pages = await load_pages(await startup(make_site(group)))
+    # 注册的页面不变,重启后跳过写入,只同步到site
+    site = make_site(group)
+    with StatementCounter(site) as counter:
+        await startup(site)
+    assert counter.writes == []
+    assert await load_pages(site) == pages
+    assert sorted(admin.__class__.__name__ for admin in site.get_admin_or_create(group)._children) == ["Page0", "Page1", "Page2"]
+
+
+async def test_restart_writes_changed_site(make_site):
+    pages = make_page_admins(3)
+    await startup(make_site(make_group_admin("Group", pages)))
+    # 新注册了页面,指纹变化,写入数据库
+    group = make_group_admin("Group", [*pages, *make_page_admins(1, "Extra")])
+    site = make_site(group)
+    with StatementCounter(site) as counter:
+        await startup(site)
+    assert counter.writes
+    # 其他进程可以读取到已经提交的修改,再次重启时跳过写入
+    site = make_site(group)
+    assert "Extra0" in {page.label for page in await load_pages(site)}
+    with StatementCounter(site) as counter:
+        await startup(site)
+    assert counter.writes == []
+
+
+async def test_restart_repairs_changed_system_pages(make_site):
+    group = make_group_admin("Group", make_page_admins(3))
+    site = await startup(make_site(group))
+    nav = site.get_admin_or_create(NavAdmin)
+    pages = {page.label: page for page in await load_pages(site)}
+    async with client(site) as c:
+        assert (await c.delete(f"{nav.router_path}/item/{pages['Page0'].id}")).json()["status"] == 0
+        res = await c.put(f"{nav.router_path}/item/{pages['Page1'].id}", json={"label": "Edited"})
+        assert res.json()["status"] == 0
+        res = await c.put(f"{nav.router_path}/item/{pages['Page2'].id}", json={"label": "Locked", "is_locked": True})
+        assert res.json()["status"] == 0
+    # 重启后恢复被删除和被修改的系统页面,锁定的页面保持修改
+    site = await startup(make_site(group))
+    labels = {page.label for page in await load_pages(site) if page.is_active}
+    assert {"Page0", "Page1", "Locked"} <= labels and "Edited" not in labels
@@ -0,0 +1,47 @@
+from typing import List
+
+from tests.conftest import (
+    NavAdmin,
+    client,
+    load_pages,
+    make_group_admin,
+    make_page_admins,
+    startup,
+)
+
+
+def strip_links(links: List[dict]) -> List[dict]:
+    """只保留amis导航拖拽排序后提交的字段"""
+    return [{"value": link["value"], "children": strip_links(link.get("children") or [])} for link in links]
+
+
+async def test_update_pages_writes_only_changed_rows(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(3))))
+    nav = site.get_admin_or_create(NavAdmin)
+    async with client(site) as c:
+        links = strip_links((await c.get(f"{nav.router_path}/get_active_pages")).json()["data"])
+        await c.post(f"{nav.router_path}/update_pages", json={"data": links})
+        # 顺序没有变化,不写入任何页面
+        res = await c.post(f"{nav.router_path}/update_pages", json={"data": links})
+        assert res.json() == {"status": 0, "msg": "success", "data": 0, "code": None}
+        # 交换分组中前两个页面的顺序,只有这两个页面的排序发生变化
+        group = next(link for link in links if link["children"])
+        group["children"][0], group["children"][1] = group["children"][1], group["children"][0]
+        res = await c.post(f"{nav.router_path}/update_pages", json={"data": links})
+        assert res.json()["data"] == 2
+    pages = sorted(await load_pages(site), key=lambda page: -page.sort)
+    assert [page.id for page in pages if page.label.startswith("Page")] == [link["value"] for link in group["children"]]
+
+
+async def test_update_pages_moves_page_and_path(make_site):
+    site = await startup(make_site(make_group_admin("Group", make_page_admins(2))))
+    nav = site.get_admin_or_create(NavAdmin)
+    async with client(site) as c:
+        links = strip_links((await c.get(f"{nav.router_path}/get_active_pages")).json()["data"])
+        group = next(link for link in links if link["children"])
+        links.append(group["children"].pop())  # 将分组中最后一个页面移动到顶级
+        res = await c.post(f"{nav.router_path}/update_pages", json={"data": links})
+        assert res.json()["status"] == 0
+    pages = {page.id: page for page in await load_pages(site)}
+    moved, root = pages[links[-1]["value"]], pages[links[0]["value"]]
+    assert (moved.parent_id, moved.path, moved.depth) == (root.id, f"/{root.id}/", 1)